@@ -45,6 +45,15 @@ def bernoulli_loglikelihood_derivitive(b, log_alpha):
     return b * sna - (1-b) * (1 - sna)
 
 
+def grouped_moments(samples, num_groups):
+    """
+    mean and variance of draws stacked along axis 0 in num_groups consecutive blocks of equal size,
+    e.g. estimators evaluated on np.repeat(examples, num_draws, axis=0)
+    """
+    draws = tf.reshape(samples, tf.concat([[num_groups, -1], tf.shape(samples)[1:]], 0))
+    return tf.nn.moments(draws, axes=[1])
+
+
 def v_from_u(u, log_alpha, force_same=True):
     # Lovingly copied from https://github.com/tensorflow/models/blob/master/research/rebar/rebar.py
     u_prime = tf.nn.sigmoid(-log_alpha)
@@ -199,6 +208,21 @@ def create_eta(num):
     )
 
 
+def optimal_eta_update(eta, reinforce, control, rebar, decay=.99):
+    """
+    assigns eta = E[reinforce * control] / E[control^2] over the batch and latents of a layer,
+    the closed-form minimizer of the variance of reinforce - eta * control
+    """
+    moments = [tf.reduce_mean(reinforce * control), tf.reduce_mean(tf.square(control))]
+    ema = tf.train.ExponentialMovingAverage(decay)
+    # rebar has to read the old eta first
+    with tf.control_dependencies([rebar]):
+        ema_op = ema.apply(moments)
+    with tf.control_dependencies([ema_op]):
+        cross, control_sq = [ema.average(m) for m in moments]
+        return tf.assign(eta, tf.reshape(cross / tf.maximum(control_sq, 1e-8), [-1]))
+
+
 class BSampler:
     def __init__(self, u, name):
         self.u = u
@@ -246,7 +270,7 @@ def get_variables(tag, arr=None):
 def main(relaxation=None, learn_prior=True, max_iters=None,
          batch_size=24, num_latents=200, model_type=None, lr=None,
          test_bias=False, train_dir=None, iwae_samples=100, dataset="mnist",
-         logf=None, var_lr_scale=10., Q_wd=.0001, Q_depth=-1, checkpoint_path=None):
+         logf=None, var_lr_scale=10., Q_wd=.0001, Q_depth=-1, checkpoint_path=None, optimal_eta=False):
 
     valid_batch_size = 100
 
@@ -355,6 +379,7 @@ def main(relaxation=None, learn_prior=True, max_iters=None,
     rebars = []
     reinforces = []
     variance_objectives = []
+    eta_update_ops = []
     # have to produce 2 forward passes for each layer for z and zt samples
     for l in range(num_layers):
         cur_la_b = inf_la_b[l]
@@ -432,6 +457,10 @@ def main(relaxation=None, learn_prior=True, max_iters=None,
         reinforce = batch_f_b * d_log_q_d_la / batch_size
         rebars.append(rebar)
         reinforces.append(reinforce)
+        if optimal_eta:
+            # rebar = (reinforce - eta * control) / batch_size, with control zero-mean
+            control = batch_f_zt * d_log_q_d_la - (d_f_z_d_la - d_f_zt_d_la)
+            eta_update_ops.append(optimal_eta_update(etas[l], batch_f_b * d_log_q_d_la, control, rebar))
         tf.summary.histogram("rebar_{}".format(l), rebar)
         tf.summary.histogram("reinforce_{}".format(l), reinforce)
         # backpropogate rebar to individual layer parameters
@@ -450,7 +479,7 @@ def main(relaxation=None, learn_prior=True, max_iters=None,
         variance_objectives.append(variance_objective)
 
     variance_objective = tf.add_n(variance_objectives)
-    variance_vars = log_temperatures + etas
+    variance_vars = log_temperatures if optimal_eta else log_temperatures + etas
     if relaxation != "rebar":
         q_vars = get_variables("Q_")
         wd = tf.add_n([Q_wd * tf.nn.l2_loss(v) for v in q_vars])
@@ -460,6 +489,8 @@ def main(relaxation=None, learn_prior=True, max_iters=None,
         wd = 0.0
     variance_gradvars = variance_opt.compute_gradients(variance_objective+wd, var_list=variance_vars)
     variance_train_op = variance_opt.apply_gradients(variance_gradvars)
+    if optimal_eta:
+        variance_train_op = tf.group(variance_train_op, *eta_update_ops)
     model_train_op = model_opt.apply_gradients(model_gradvars)
     with tf.control_dependencies([model_train_op, variance_train_op]):
         train_op = tf.no_op()
@@ -470,6 +501,12 @@ def main(relaxation=None, learn_prior=True, max_iters=None,
             tf.summary.histogram(v.name, v)
             tf.summary.histogram(v.name+"_grad", g)
 
+    if test_bias:
+        # every row draws its own noise, so repeated examples give independent estimator draws
+        bias_examples, bias_draws, bias_runs = 5, 2000, 50
+        rebar_moments = grouped_moments(rebars[-1], bias_examples)
+        reinforce_moments = grouped_moments(reinforces[-1], bias_examples)
+
     val_loss = tf.Variable(1000, trainable=False, name="val_loss", dtype=tf.float32)
     train_loss = tf.Variable(1000, trainable=False, name="train_loss", dtype=tf.float32)
     tf.summary.scalar("val_loss", val_loss)
@@ -511,22 +548,17 @@ def main(relaxation=None, learn_prior=True, max_iters=None,
                     t = time.time()
                     #print(cur_iter, loss, "{} / batch".format(time_taken / 1000))
                     if test_bias:
-                        rebs = []
-                        refs = []
-                        for _i in range(100000):
-                            if _i % 1000 == 0:
-                                print(_i)
-                            rb, re = sess.run([rebars[3], reinforces[3]], feed_dict={x: batch_xs})
-                            rebs.append(rb[:5])
-                            refs.append(re[:5])
-                        rebs = np.array(rebs)
-                        refs = np.array(refs)
-                        re_var = np.log(refs.var(axis=0))
-                        rb_var = np.log(rebs.var(axis=0))
+                        bias_xs = np.repeat(batch_xs[:bias_examples], bias_draws, axis=0)
+                        runs = [sess.run([rebar_moments, reinforce_moments], feed_dict={x: bias_xs})
+                                for _i in range(bias_runs)]
+                        # pool the equal-sized runs: mean of means, mean of variances plus variance of means
+                        (rb_means, rb_vars), (re_means, re_vars) = [map(np.array, zip(*m)) for m in zip(*runs)]
+                        re_var = np.log(re_vars.mean(axis=0) + re_means.var(axis=0))
+                        rb_var = np.log(rb_vars.mean(axis=0) + rb_means.var(axis=0))
                         print("rebar variance     = {}".format(rb_var))
                         print("reinforce variance = {}".format(re_var))
-                        print("rebar     = {}".format(rebs.mean(axis=0)))
-                        print("reinforce = {}\n".format(refs.mean(axis=0)))
+                        print("rebar     = {}".format(rb_means.mean(axis=0)))
+                        print("reinforce = {}\n".format(re_means.mean(axis=0)))
                 else:
                     loss, _ = sess.run([total_loss, train_op], feed_dict={x: batch_xs})
 
@@ -580,6 +612,7 @@ if __name__ == "__main__":
     parser.add_argument("--var_lr_scale", type=float, default=10.)
     parser.add_argument("--Q_depth", type=int, default=-1)
     parser.add_argument("--Q_wd", type=float, default=0.0)
+    parser.add_argument("--optimal_eta", action="store_true")
     FLAGS = parser.parse_args()
 
     td = FLAGS.train_dir
@@ -597,6 +630,7 @@ if __name__ == "__main__":
         f.write("{}: {}\n".format("max_iters", FLAGS.max_iters))
         f.write("{}: {}\n".format("dataset", FLAGS.dataset))
         f.write("{}: {}\n".format("var_lr_scale", FLAGS.var_lr_scale))
+        f.write("{}: {}\n".format("optimal_eta", FLAGS.optimal_eta))
         if FLAGS.relaxation != "rebar":
             f.write("{}: {}\n".format("Q_depth", FLAGS.Q_depth))
             f.write("{}: {}\n".format("Q_wd", FLAGS.Q_wd))
@@ -606,5 +640,6 @@ if __name__ == "__main__":
             relaxation=FLAGS.relaxation, train_dir=td, dataset=FLAGS.dataset,
             lr=FLAGS.lr, model_type=FLAGS.model, max_iters=FLAGS.max_iters,
             logf=logf, var_lr_scale=FLAGS.var_lr_scale,
-            Q_depth=FLAGS.Q_depth, Q_wd=FLAGS.Q_wd, checkpoint_path=FLAGS.checkpoint_path
+            Q_depth=FLAGS.Q_depth, Q_wd=FLAGS.Q_wd, checkpoint_path=FLAGS.checkpoint_path,
+            optimal_eta=FLAGS.optimal_eta
         )
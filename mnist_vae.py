@@ -32,6 +32,7 @@ if __name__ == "__main__":
     TRAIN_DIR = "./rebar_new_u_and_v"
     reinforce = False
     relaxed = False
+    stack_evaluations = True
     if os.path.exists(TRAIN_DIR):
         print("Deleting existing train dir")
         import shutil
@@ -56,30 +57,36 @@ if __name__ == "__main__":
     log_alpha_v = tf.reshape(log_alpha, [-1])
     evals = 0
     def loss(b):
-        log_q_b_given_x = bernoulli_loglikelihood(b, log_alpha)
-        log_q_b_given_x = tf.reduce_mean(tf.reduce_sum(log_q_b_given_x, axis=1))
+        # b holds one or more batches of latents stacked along axis 0 (three when the
+        # optimizer stacks its evaluations), returns the loss of each stacked batch
+        num_stacked = gs(b)[0] // batch_size
+        stacked_log_alpha = tf.tile(log_alpha, [num_stacked, 1])
+        stacked_x_binary = tf.tile(x_binary, [num_stacked, 1])
+        def batch_mean(t):
+            return tf.reduce_mean(tf.reshape(tf.reduce_sum(t, axis=1), [num_stacked, batch_size]), axis=1)
 
-        log_p_b = bernoulli_loglikelihood(b, tf.zeros_like(log_alpha))
-        log_p_b = tf.reduce_mean(tf.reduce_sum(log_p_b, axis=1))
+        log_q_b_given_x = batch_mean(bernoulli_loglikelihood(b, stacked_log_alpha))
+        log_p_b = batch_mean(bernoulli_loglikelihood(b, tf.zeros_like(stacked_log_alpha)))
 
         with tf.variable_scope("decoder", reuse=evals>0):
             log_alpha_x_batch = decoder(b)
-        log_p_x_given_b = bernoulli_loglikelihood(x_binary, log_alpha_x_batch)
-        log_p_x_given_b = tf.reduce_mean(tf.reduce_sum(log_p_x_given_b, axis=1))
+        log_p_x_given_b = batch_mean(bernoulli_loglikelihood(stacked_x_binary, log_alpha_x_batch))
         # HACKY BS
         global evals
         if evals == 0:
             # if first eval make image summary
-            a = tf.exp(log_alpha_x_batch)
+            a = tf.exp(log_alpha_x_batch[:batch_size])
             log_theta_x = a / (1 + a)
             log_theta = tf.reshape(log_theta_x, [batch_size, 28, 28, 1])
             tf.summary.image("x_pred", log_theta)
         evals += 1
-        return -tf.expand_dims(log_p_x_given_b + log_p_b - log_q_b_given_x, 0)
+        return -(log_p_x_given_b + log_p_b - log_q_b_given_x)
     if relaxed:
-        rebar_optimizer = RelaxedREBAROptimizer(sess, loss, Q_func, log_alpha=log_alpha, learning_rate=lr)
+        rebar_optimizer = RelaxedREBAROptimizer(sess, loss, Q_func, log_alpha=log_alpha, learning_rate=lr,
+                                                stack_evaluations=stack_evaluations)
     else:
-        rebar_optimizer = REBAROptimizer(sess, loss, log_alpha=log_alpha, learning_rate=lr)
+        rebar_optimizer = REBAROptimizer(sess, loss, log_alpha=log_alpha, learning_rate=lr,
+                                         stack_evaluations=stack_evaluations)
     gen_loss = rebar_optimizer.f_b
     tf.summary.scalar("loss", gen_loss[0])
     gen_opt = tf.train.AdamOptimizer(lr)
@@ -93,10 +100,8 @@ if __name__ == "__main__":
     inf_gradvars = zip(inf_grads, inf_vars)
     inf_opt = tf.train.AdamOptimizer(lr)
     inf_train_op = inf_opt.apply_gradients(inf_gradvars)
-    if relaxed:
-        gradvars = inf_gradvars + gen_gradvars + rebar_optimizer.variance_gradvars + rebar_optimizer.Q_gradvars
-    else:
-        gradvars = inf_gradvars + gen_gradvars + rebar_optimizer.variance_gradvars
+    # includes the Q gradients when relaxed
+    gradvars = inf_gradvars + gen_gradvars + rebar_optimizer.variance_gradvars
     for g, v in gradvars:
         tf.summary.histogram(v.name, v)
         tf.summary.histogram(v.name+"_grad", g)
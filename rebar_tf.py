@@ -1,3 +1,10 @@
+import threading
+import time
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
+
 import numpy as np
 import tensorflow as tf
 
@@ -43,8 +50,78 @@ def bernoulli_loglikelihood_derivitive(b, log_alpha):
     return b * sna - (1-b) * (1 - sna)
 
 
+def stacked_evaluation(func, inputs):
+    """
+    evaluates func once on inputs concatenated along axis 0 and splits the output back into
+    len(inputs) equal parts, func must treat each stacked input independently
+    """
+    return tf.split(func(tf.concat(inputs, 0)), len(inputs), axis=0)
+
+
+def estimator_moments(draw, num_draws, parallel_iterations=10):
+    """
+    means and variances over num_draws draws of each tensor in the list returned by draw(), which
+    must build its estimators from fresh noise every time it is called. the draws run inside one
+    tf.while_loop with streaming (Welford) moments, so a single sess.run returns the statistics.
+    summaries made by draw() are dropped, they can not be fetched from inside the loop
+    """
+    summaries = list(tf.get_collection(tf.GraphKeys.SUMMARIES))
+    first = draw()
+
+    def body(i, means, m2s):
+        n = tf.to_float(i + 1)
+        new_means, new_m2s = [], []
+        for x, mean, m2 in zip(draw(), means, m2s):
+            delta = x - mean
+            mean = mean + delta / n
+            new_means.append(mean)
+            new_m2s.append(m2 + delta * (x - mean))
+        return i + 1, new_means, new_m2s
+
+    _, means, m2s = tf.while_loop(
+        lambda i, means, m2s: i < num_draws, body,
+        [tf.constant(1), first, [tf.zeros_like(x) for x in first]],
+        parallel_iterations=parallel_iterations, back_prop=False
+    )
+    tf.get_collection_ref(tf.GraphKeys.SUMMARIES)[:] = summaries
+    return [(mean, m2 / num_draws) for mean, m2 in zip(means, m2s)]
+
+
+class SummaryWriterThread(threading.Thread):
+    """
+    writes serialized summaries to a FileWriter from a background thread. add_summary never blocks,
+    when the bounded queue is full the summary is dropped and counted instead
+    """
+    def __init__(self, logdir, max_queue=10):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = Queue(max_queue)
+        self.writer = tf.summary.FileWriter(logdir)
+        self.dropped = 0
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            self.writer.add_summary(*item)
+        self.writer.close()
+
+    def add_summary(self, summary_str, step):
+        try:
+            self.queue.put_nowait((summary_str, step))
+        except Full:
+            self.dropped += 1
+
+    def close(self):
+        # waits for the queued summaries to be written
+        self.queue.put(None)
+        self.join()
+
+
 class REBAROptimizer(object):
-    def __init__(self, sess, loss, log_alpha=None, dim=None, name="REBAR", learning_rate=.01, n_samples=1):
+    def __init__(self, sess, loss, log_alpha=None, dim=None, name="REBAR", learning_rate=.01, n_samples=1,
+                 optimal_eta=False, eta_decay=.99, stack_evaluations=False):
         self.name = name
         self.sess = sess
         self.loss = loss
@@ -52,6 +129,11 @@ class REBAROptimizer(object):
         self.log_alpha = log_alpha
         self.learning_rate = learning_rate
         self.n_samples = n_samples
+        # set eta in closed form from running moments instead of descending its variance gradient
+        self.optimal_eta = optimal_eta
+        self.eta_decay = eta_decay
+        # evaluate f(b), f(sig(z)), f(sig(z_tilde)) as one batch of 3 * batch_size rows
+        self.stack_evaluations = stack_evaluations
         self.variance_optimizer = tf.train.AdamOptimizer(learning_rate)
 
         """ model parameters """
@@ -64,6 +146,13 @@ class REBAROptimizer(object):
         self._create_gradvars()
         """ variance reduction optimization operation """
         self.variance_reduction_op = self.variance_optimizer.apply_gradients(self.variance_gradvars)
+        if self.optimal_eta:
+            self.variance_reduction_op = tf.group(self.variance_reduction_op, self.eta_update_op)
+        """ rebar optimization operation, only when log_alpha is our own variable """
+        if isinstance(self.log_alpha, tf.Variable):
+            self.rebar_op = tf.train.AdamOptimizer(learning_rate).apply_gradients(self.rebar_gradvars)
+        else:
+            self.rebar_op = tf.no_op()
 
     def _create_model_parameters(self):
         # alpha = theta / (1 - theta)
@@ -85,8 +174,8 @@ class REBAROptimizer(object):
         a = tf.exp(self.log_alpha)
         theta = a / (1 + a)
         tf.summary.histogram("theta", theta)
-        # expanded version for internal purposes
-        self._log_alpha = tf.expand_dims(self.log_alpha, 0)
+        # one copy per sample for internal purposes, so gradients wrt it are per-sample
+        self._log_alpha = tf.tile(tf.expand_dims(self.log_alpha, 0), [self.n_samples, 1])
         n_vars = self.dim / self.batch_size
         self.n_vars = n_vars
         self.batch_log_temperature = tf.Variable(
@@ -108,6 +197,12 @@ class REBAROptimizer(object):
         self.eta = tf.reshape(tf.tile(tf.expand_dims(self.batch_eta, 0), [self.batch_size, 1]), [-1])
 
     def _create_reparam_variables(self, eps=1e-8):
+        self.b, self.z, self.z_tilde = self._reparameterize(eps)
+
+    def _reparameterize(self, eps=1e-8):
+        """
+        draws fresh noise and returns b, z, z_tilde
+        """
         # noise for generating z
         u = tf.random_uniform([self.n_samples, self.dim], dtype=tf.float32)
         log_alpha = self._log_alpha
@@ -132,134 +227,222 @@ class REBAROptimizer(object):
         tf.summary.histogram("u-v", u-v)
 
         z_tilde = log_alpha + safe_log_prob(v) - safe_log_prob(1 - v)
-        self.b = b
-        self.z = z
-        self.z_tilde = z_tilde
+        return b, z, z_tilde
 
     def _create_loss_evaluations(self):
+        self.f_b, self.f_z, self.f_z_tilde = self._evaluate_losses(self.b, self.z, self.z_tilde)
+
+    def _evaluate_losses(self, b, z, z_tilde, reuse=False):
         """
         produces f(b), f(sig(z)), f(sig(z_tilde))
         """
         # relaxed inputs
         log_alpha = self._log_alpha
-        sig_z = tf.nn.sigmoid(self.z / self.temperature + log_alpha)
-        sig_z_tilde = tf.nn.sigmoid(self.z_tilde / self.temperature + log_alpha)
-        # evaluate loss
-        f_b = tf.reshape(self.loss(tf.reshape(self.b, [self.batch_size, -1])), [-1])
-        f_z = tf.reshape(self.loss(tf.reshape(sig_z, [self.batch_size, -1])), [-1])
-        f_z_tilde = tf.reshape(self.loss(tf.reshape(sig_z_tilde, [self.batch_size, -1])), [-1])
-        self.f_b = f_b
-        self.f_z = f_z
-        self.f_z_tilde = f_z_tilde
+        sig_z = tf.nn.sigmoid(z / self.temperature + log_alpha)
+        sig_z_tilde = tf.nn.sigmoid(z_tilde / self.temperature + log_alpha)
+        # evaluate loss, samples are stacked along the batch axis
+        inputs = [tf.reshape(inp, [self.n_samples * self.batch_size, -1]) for inp in [b, sig_z, sig_z_tilde]]
+        if self.stack_evaluations:
+            f_b, f_z, f_z_tilde = [tf.reshape(f, [-1]) for f in stacked_evaluation(self.loss, inputs)]
+        else:
+            f_b, f_z, f_z_tilde = [tf.reshape(self.loss(inp), [-1]) for inp in inputs]
+        return f_b, f_z, f_z_tilde
 
     def _create_gradvars(self):
         """
-        produces d[log p(b)]/d[log_alpha], d[f(sigma_theta(z))]/d[log_alpha], d[f(sigma_theta(z_tilde))]/d[log_alpha]
+        produces the rebar and reinforce gradients and the gradients of the variance of rebar
         """
-        log_alpha = self._log_alpha
-        eta = tf.expand_dims(self.eta, 0)
-        f_b = tf.expand_dims(self.f_b, 1)
-        f_z_tilde = tf.expand_dims(self.f_z_tilde, 1)
-        d_log_p_d_log_alpha = bernoulli_loglikelihood_derivitive(self.b, log_alpha)
-        term1 = ((f_b - eta * f_z_tilde) * d_log_p_d_log_alpha)[0]
-        # d[f(sigma_theta(z))]/d[log_alpha] - eta * d[f(sigma_theta(z_tilde))]/d[log_alpha]
-        term2 = tf.gradients(
-            tf.reduce_mean(self.f_z - self.f_z_tilde),
-            self.log_alpha
-        )[0]
-        # rebar gradient estimator
-        rebar = term1 + self.eta * term2
-        reinforce = (f_b * d_log_p_d_log_alpha)[0]
+        rebar_samples, reinforce_samples, control = self._estimator_samples(
+            self.b, self.f_b, self.f_z, self.f_z_tilde
+        )
+        rebar = tf.reshape(tf.reduce_mean(rebar_samples, axis=0), [-1])
+        reinforce = tf.reshape(tf.reduce_mean(reinforce_samples, axis=0), [-1])
         # now compute gradients of the variance of this wrt other parameters
-        # eta
-        d_var_d_eta = tf.gradients(
-            tf.reduce_sum(tf.square(rebar)) / self.batch_size,
-            self.batch_eta
-        )[0]
-        # temperature
-        d_var_d_temperature = tf.gradients(
-            tf.reduce_sum(tf.square(rebar)) / self.batch_size,
-            self.batch_log_temperature
-        )[0]
+        if self.n_samples > 1:
+            # unbiased across-sample variance of the per-sample estimates
+            _, rebar_var = tf.nn.moments(rebar_samples, axes=[0])
+            self.rebar_variance = tf.reduce_sum(rebar_var) * self.n_samples / (self.n_samples - 1.) / self.batch_size
+        else:
+            self.rebar_variance = tf.reduce_sum(tf.square(rebar)) / self.batch_size
+        # one backward pass for all control variate parameters
+        variance_vars = self._variance_vars()
+        variance_grads = tf.gradients(self.rebar_variance, variance_vars)
+        if self.optimal_eta:
+            self.eta_update_op = self._create_optimal_eta_update(reinforce_samples, control, rebar)
         self._rebar = rebar
         self.rebar = tf.reshape(rebar, [self.batch_size, -1])
         self.reinforce = tf.reshape(reinforce, [self.batch_size, -1])
         tf.summary.histogram("rebar_gradient", rebar)
         tf.summary.histogram("reinforce_gradient", reinforce)
         self.rebar_gradvars = [(rebar, self.log_alpha)]
-        self.variance_gradvars = [(d_var_d_eta, self.batch_eta), (d_var_d_temperature, self.batch_log_temperature)]
+        self.variance_gradvars = list(zip(variance_grads, variance_vars))
 
-    def train(self, n_steps=10000):
-        self.sess.run(tf.global_variables_initializer())
+    def _variance_vars(self):
+        """
+        parameters trained to minimize the variance of rebar, eta is set in closed form with optimal_eta
+        """
+        if self.optimal_eta:
+            return [self.batch_log_temperature]
+        return [self.batch_eta, self.batch_log_temperature]
+
+    def _estimator_samples(self, b, f_b, f_z, f_z_tilde):
+        """
+        produces per-sample rebar, reinforce and control with shape [n_samples, batch_size, n_vars],
+        from d[log p(b)]/d[log_alpha], d[f(sigma_theta(z))]/d[log_alpha], d[f(sigma_theta(z_tilde))]/d[log_alpha]
+        """
+        sample_shape = [self.n_samples, self.batch_size, -1]
+        log_alpha = self._log_alpha
+        eta = tf.reshape(self.eta, [1, self.batch_size, -1])
+        # a loss gives one value per sample or per sample and batch row, the relaxed
+        # evaluations must match so each row is paired with its own control variate
+        assert gs(f_b) == gs(f_z) == gs(f_z_tilde)
+        batch_f_b = tf.reshape(f_b, [self.n_samples, -1, 1])
+        batch_f_z_tilde = tf.reshape(f_z_tilde, [self.n_samples, -1, 1])
+        d_log_p_d_log_alpha = tf.reshape(bernoulli_loglikelihood_derivitive(b, log_alpha), sample_shape)
+        term1 = (batch_f_b - eta * batch_f_z_tilde) * d_log_p_d_log_alpha
+        # d[f(sigma_theta(z))]/d[log_alpha] - eta * d[f(sigma_theta(z_tilde))]/d[log_alpha], each value
+        # only depends on its own sample (and row, for a per-row loss), so a sum gives every row its own
+        term2 = tf.gradients(
+            tf.reduce_sum(f_z - f_z_tilde),
+            log_alpha
+        )[0]
+        term2 = tf.reshape(term2, sample_shape)
+        # rebar gradient estimator
+        rebar = term1 + eta * term2
+        reinforce = batch_f_b * d_log_p_d_log_alpha
+        # rebar = reinforce - eta * control, with control zero-mean
+        control = batch_f_z_tilde * d_log_p_d_log_alpha - term2
+        return rebar, reinforce, control
+
+    def estimator_statistics(self, num_draws):
+        """
+        means and variances of the rebar and reinforce gradients over num_draws draws of the noise,
+        returned as [(rebar_mean, rebar_var), (reinforce_mean, reinforce_var)] for a single sess.run
+        """
+        def draw():
+            b, z, z_tilde = self._reparameterize()
+            f_b, f_z, f_z_tilde = self._evaluate_losses(b, z, z_tilde, reuse=True)
+            rebar, reinforce, _ = self._estimator_samples(b, f_b, f_z, f_z_tilde)
+            return [tf.reshape(tf.reduce_mean(g, axis=0), [self.batch_size, -1]) for g in [rebar, reinforce]]
+        return estimator_moments(draw, num_draws)
+
+    def _create_optimal_eta_update(self, reinforce, control, rebar):
+        """
+        assigns batch_eta = E[reinforce * control] / E[control^2] per variable, which minimizes
+        the variance of reinforce - eta * control, using moving averages of the moments
+        """
+        rows = self.n_samples * self.batch_size
+        cross = tf.reduce_mean(tf.reshape(reinforce * control, [rows, -1]), axis=0)
+        control_sq = tf.reduce_mean(tf.reshape(tf.square(control), [rows, -1]), axis=0)
+        ema = tf.train.ExponentialMovingAverage(self.eta_decay)
+        # this step's rebar must read eta before it is reassigned
+        with tf.control_dependencies([rebar]):
+            ema_op = ema.apply([cross, control_sq])
+        with tf.control_dependencies([ema_op]):
+            optimal_eta = ema.average(cross) / tf.maximum(ema.average(control_sq), 1e-8)
+            return tf.assign(self.batch_eta, optimal_eta)
+
+    def train(self, n_steps=10000, train_op=None, feed_dict_fn=None, summary_every=100, log_every=1000,
+              logdir="/tmp/rebar", max_queue=10, initialize=True):
+        """
+        runs train_op (by default the rebar update of log_alpha) with the variance reduction op for n_steps.
+        feed_dict_fn(step) gives the feed dict of a step. every summary_every steps the merged summaries
+        are fetched with the step and written by a background thread, so the loop never waits on disk.
+        returns the average steps/sec
+        """
+        if train_op is None:
+            train_op = self.rebar_op
+        step_op = tf.group(train_op, self.variance_reduction_op)
         ave_loss = tf.reduce_mean(self.f_b)
         summ_op = tf.summary.merge_all()
-        summary_writer = tf.summary.FileWriter("/tmp/rebar")
-        for iter in xrange(n_steps):
-            if iter % 100 == 0:
-                _, sum_str, loss_val, g_val, g_val_r, la, t, e = sess.run(
-                    [self.train_op, summ_op, ave_loss, self.rebar, self.reinforce, self.log_alpha, self.log_temperature, self.eta])
-                summary_writer.add_summary(sum_str, iter)
-            else:
-                _, loss_val, g_val, g_val_r, la, t, e = sess.run(
-                [self.train_op, ave_loss, self.rebar, self.reinforce, self.log_alpha, self.log_temperature, self.eta])
+        if initialize:
+            self.sess.run(tf.global_variables_initializer())
+        summary_writer = SummaryWriterThread(logdir, max_queue)
+        summary_writer.start()
+        start = log_start = time.time()
+        try:
+            for step in range(n_steps):
+                feed_dict = None if feed_dict_fn is None else feed_dict_fn(step)
+                summarize = summ_op is not None and step % summary_every == 0
+                log = (step + 1) % log_every == 0
+                fetches = [step_op]
+                if summarize:
+                    fetches.append(summ_op)
+                if log:
+                    fetches.append(ave_loss)
+                results = self.sess.run(fetches, feed_dict=feed_dict)
+                if summarize:
+                    summary_writer.add_summary(results[1], step)
+                if log:
+                    now = time.time()
+                    print("step {}, loss = {}, {:.1f} steps/sec".format(step + 1, results[-1], log_every / (now - log_start)))
+                    log_start = now
+        finally:
+            summary_writer.close()
+        steps_per_sec = n_steps / (time.time() - start)
+        print("{} steps, {:.1f} steps/sec, {} summaries dropped".format(n_steps, steps_per_sec, summary_writer.dropped))
+        return steps_per_sec
 
 
 class RelaxedREBAROptimizer(REBAROptimizer):
-    def __init__(self, sess, loss, q_func, log_alpha=None, dim=None, name="REBAR", learning_rate=.01, n_samples=1):
+    def __init__(self, sess, loss, q_func, log_alpha=None, dim=None, name="REBAR", learning_rate=.01, n_samples=1,
+                 optimal_eta=False, eta_decay=.99, stack_evaluations=False):
         self.q_func = q_func
-        super(RelaxedREBAROptimizer, self).__init__(sess, loss, log_alpha, dim, name, learning_rate, n_samples)
-        self.Q_optimizer = tf.train.AdamOptimizer(learning_rate)
-        self.Q_vars = [v for v in tf.trainable_variables() if "Q_func" in v.name]
-        self._Q_gradvars()
-        self.Q_opt_op = self.Q_optimizer.apply_gradients(self.Q_gradvars)
-        old_var_op = self.variance_reduction_op
-        with tf.control_dependencies([self.Q_opt_op, old_var_op]):
-            self.variance_reduction_op = tf.no_op()
-
+        super(RelaxedREBAROptimizer, self).__init__(sess, loss, log_alpha, dim, name, learning_rate, n_samples,
+                                                    optimal_eta, eta_decay, stack_evaluations)
+        # the Q gradients come from the same backward pass and are applied by the variance reduction op
+        self.Q_gradvars = [(g, v) for g, v in self.variance_gradvars if any(v is q for q in self.Q_vars)]
 
     def _create_loss_evaluations(self):
+        super(RelaxedREBAROptimizer, self)._create_loss_evaluations()
+        # the variables q_func made under this optimizer's Q_func scope
+        outer_scope = tf.get_variable_scope().name
+        self.Q_vars = tf.get_collection(
+            tf.GraphKeys.TRAINABLE_VARIABLES, scope=(outer_scope + "/" if outer_scope else "") + "Q_func/"
+        )
+
+
+    def _evaluate_losses(self, b, z, z_tilde, reuse=False):
         """
         produces f(b), f(sig(z)), f(sig(z_tilde))
         """
         # relaxed inputs
         log_alpha = self._log_alpha
-        sig_z = tf.nn.sigmoid(self.z / self.temperature + log_alpha)
-        sig_z_tilde = tf.nn.sigmoid(self.z_tilde / self.temperature + log_alpha)
-        # evaluate loss
-        f_b = tf.reshape(self.loss(tf.reshape(self.b, [self.batch_size, -1])), [-1])
-        z_inp = tf.reshape(sig_z, [self.batch_size, -1])
-        z_tilde_inp = tf.reshape(sig_z_tilde, [self.batch_size, -1])
-        l_z = self.loss(z_inp)
-        l_z_tilde = self.loss(z_tilde_inp)
-        with tf.variable_scope("Q_func"):
-            f_z = tf.reshape(self.q_func(z_inp) + l_z, [-1])
-        with tf.variable_scope("Q_func", reuse=True):
-            f_z_tilde = tf.reshape(self.q_func(z_tilde_inp) + l_z_tilde, [-1])
-
-        self.f_b = f_b
-        self.f_z = f_z
-        self.f_z_tilde = f_z_tilde
-        tf.summary.scalar("f_b", tf.reduce_mean(self.f_b))
-        tf.summary.scalar("f_z_tilde", tf.reduce_mean(self.f_z_tilde))
-        tf.summary.scalar("f_z", tf.reduce_mean(self.f_z))
-
-    def _Q_gradvars(self):
-        """
-        produces d[log p(b)]/d[log_alpha], d[f(sigma_theta(z))]/d[log_alpha], d[f(sigma_theta(z_tilde))]/d[log_alpha]
-        """
-        print(gs(self._rebar), gs(self.rebar))
-        self.Q_gradvars = []
-        for var in self.Q_vars:
-            d_var_d_v = tf.gradients(
-                tf.reduce_sum(tf.square(self._rebar)) / self.batch_size,
-                var
-            )[0]
-            # d_var_d_v = tf.gradients(
-            #     tf.reduce_mean(tf.square(self.f_b - self.f_z_tilde) + tf.square(self.f_b - self.f_z)),
-            #     var
-            # )[0]
-            print(var.name, gs(d_var_d_v))
-            self.Q_gradvars.append((d_var_d_v, var))
+        sig_z = tf.nn.sigmoid(z / self.temperature + log_alpha)
+        sig_z_tilde = tf.nn.sigmoid(z_tilde / self.temperature + log_alpha)
+        # evaluate loss, samples are stacked along the batch axis
+        rows = self.n_samples * self.batch_size
+        b_inp = tf.reshape(b, [rows, -1])
+        z_inp = tf.reshape(sig_z, [rows, -1])
+        z_tilde_inp = tf.reshape(sig_z_tilde, [rows, -1])
+        if self.stack_evaluations:
+            l_b, l_z, l_z_tilde = stacked_evaluation(self.loss, [b_inp, z_inp, z_tilde_inp])
+            f_b = tf.reshape(l_b, [-1])
+            with tf.variable_scope("Q_func", reuse=reuse):
+                q_z, q_z_tilde = stacked_evaluation(self.q_func, [z_inp, z_tilde_inp])
+        else:
+            f_b = tf.reshape(self.loss(b_inp), [-1])
+            l_z = self.loss(z_inp)
+            l_z_tilde = self.loss(z_tilde_inp)
+            with tf.variable_scope("Q_func", reuse=reuse):
+                q_z = self.q_func(z_inp)
+            with tf.variable_scope("Q_func", reuse=True):
+                q_z_tilde = self.q_func(z_tilde_inp)
+        # Q gives one value per row, summed over the rows of a sample when the loss gives
+        # one value per sample, so the control variate has the shape of f(b)
+        def control_variate(q, l):
+            l = tf.reshape(l, [self.n_samples, -1])
+            q = tf.reduce_sum(tf.reshape(q, [self.n_samples, gs(l)[1], -1]), axis=2)
+            return tf.reshape(q + l, [-1])
+        f_z = control_variate(q_z, l_z)
+        f_z_tilde = control_variate(q_z_tilde, l_z_tilde)
+        tf.summary.scalar("f_b", tf.reduce_mean(f_b))
+        tf.summary.scalar("f_z_tilde", tf.reduce_mean(f_z_tilde))
+        tf.summary.scalar("f_z", tf.reduce_mean(f_z))
+        return f_b, f_z, f_z_tilde
+
+    def _variance_vars(self):
+        return super(RelaxedREBAROptimizer, self)._variance_vars() + self.Q_vars
 
 
 
@@ -271,10 +454,36 @@ if __name__ == "__main__":
     sess = tf.Session()
     r_opt = REBAROptimizer(sess, loss, dim=10, learning_rate=.1, n_samples=1)
 
+    """
+    Unbiasedness check, batch of 4 and 5 samples: mean rebar against mean reinforce
+    """
+    def per_sample_loss(b):
+        return tf.reduce_mean(tf.reshape(loss(b), [-1, 4]), axis=1)
+    def q_func(z):
+        return tf.layers.dense(z, 1, name="q")
+    bias_checks = []
+    for name, loss_func, relaxed in [("rebar, per-row loss", loss, False),
+                                     ("relax, per-row loss", loss, True),
+                                     ("relax, per-sample loss", per_sample_loss, True)]:
+        with tf.variable_scope(name.replace(", ", "_").replace(" ", "_").replace("-", "_")):
+            check_log_alpha = tf.Variable(np.random.RandomState(0).randn(4, 10).astype(np.float32))
+            if relaxed:
+                check_opt = RelaxedREBAROptimizer(sess, loss_func, q_func, log_alpha=check_log_alpha, n_samples=5)
+            else:
+                check_opt = REBAROptimizer(sess, loss_func, log_alpha=check_log_alpha, n_samples=5)
+            bias_checks.append((name, check_opt.estimator_statistics(10000)))
+
     """
     Bias and Variance test
     """
+    # 10000 draws of each estimator per sess.run
+    (rebar_mean, rebar_var), (reinforce_mean, reinforce_var) = r_opt.estimator_statistics(10000)
     r_opt.sess.run(tf.global_variables_initializer())
+    for name, ((check_rebar, check_rebar_var), (check_reinforce, check_reinforce_var)) in bias_checks:
+        reb_m, reb_v, ref_m, ref_v = sess.run([check_rebar, check_rebar_var, check_reinforce, check_reinforce_var])
+        # standard error of the difference of the two means over 10000 draws
+        std_err = np.sqrt((reb_v + ref_v) / 10000)
+        print("{}: max |rebar - reinforce| / std err = {}".format(name, np.max(np.abs(reb_m - ref_m) / std_err)))
     summ_op = tf.summary.merge_all()
     summary_writer = tf.summary.FileWriter("/tmp/rebar")
     percent_dims = []
@@ -283,20 +492,15 @@ if __name__ == "__main__":
     reinforce_vars = []
     reinforce_means = []
     for iter in xrange(100):
-        rebars = []
-        reinforces = []
-        for i in range(10000):
-            [reb, ref] = sess.run([r_opt.rebar, r_opt.reinforce])
-            rebars.append(reb)
-            reinforces.append(ref)
-        rebar_vars.append(np.var(rebars, axis=0))
-        reinforce_vars.append(np.var(reinforces, axis=0))
-        rebar_means.append(np.mean(rebars, axis=0))
-        reinforce_means.append(np.mean(reinforces, axis=0))
+        reb_m, reb_v, ref_m, ref_v = sess.run([rebar_mean, rebar_var, reinforce_mean, reinforce_var])
+        rebar_vars.append(reb_v)
+        reinforce_vars.append(ref_v)
+        rebar_means.append(reb_m)
+        reinforce_means.append(ref_m)
         print("vars", np.mean(rebar_vars[-1]), np.mean(reinforce_vars[-1]))
-        print("means", rebar_means[-1][3], reinforce_means[-1][3])
+        print("means", rebar_means[-1][0, 3], reinforce_means[-1][0, 3])
         print()
-        sess.run(r_opt.train_op)
+        sess.run([r_opt.rebar_op, r_opt.variance_reduction_op])
 
 
 
@@ -10,6 +10,7 @@ import matplotlib.pyplot as plt
 import cPickle as pickle
 import pandas
 import seaborn as sns
+from rebar_tf import estimator_moments
 sns.set()
 sns.set_style("white", {"axes.edgecolor": ".7"})
 sns.set_style("ticks")
@@ -159,14 +160,6 @@ def main(t=0.499, rand_seed=42, use_reinforce=False, relaxed=False, visualize=Fa
 
         tf.set_random_seed(rand_seed)  # fix for repeatable experiments
 
-        # reparameterization variables
-        u = tf.random_uniform([batch_size, num_latents], dtype=tf.float32)
-        v_p = tf.random_uniform([batch_size, num_latents], dtype=tf.float32)
-        z = reparameterize(log_alpha, u) # z(u)
-        b = tf.to_float(tf.stop_gradient(z > 0))
-        v = v_from_u(u, log_alpha, force_same, b, v_p)
-        z_tilde = reparameterize(log_alpha, v)
-
         # rebar variables
         eta = tf.Variable(
             [1.0 for i in range(num_latents)],
@@ -182,39 +175,77 @@ def main(t=0.499, rand_seed=42, use_reinforce=False, relaxed=False, visualize=Fa
         )
         temperature = tf.exp(log_temperature)
 
-        # loss function evaluations
-        f_b = loss_func(b, target)
-
-        # if we are relaxing the relaxation
-        if relaxed == "relaxation":
-            with tf.variable_scope("Q_func"):
-                sig_z = Q_func(z)
-            with tf.variable_scope("Q_func", reuse=True):
-                sig_z_tilde = Q_func(z_tilde)
-            f_z = loss_func(sig_z, target)
-            f_z_tilde = loss_func(sig_z_tilde, target)
-
-        else:
-            # relaxation variables
-            batch_temp = tf.expand_dims(temperature, 0)
-            sig_z = concrete_relaxation(z, batch_temp)
-            sig_z_tilde = concrete_relaxation(z_tilde, batch_temp)
-
-            f_z = loss_func(sig_z, target)
-            f_z_tilde = loss_func(sig_z_tilde, target)
-
-            if relaxed != False:
-                with tf.variable_scope("Q_func"):
-                    q_z = Q_func(sig_z)[:, 0]
+        def build_estimators(reuse=False):
+            """
+            draws fresh noise and builds the loss evaluations and the rebar and reinforce estimators,
+            called again with reuse=True to redraw them for estimator statistics
+            """
+            # reparameterization variables
+            u = tf.random_uniform([batch_size, num_latents], dtype=tf.float32)
+            v_p = tf.random_uniform([batch_size, num_latents], dtype=tf.float32)
+            z = reparameterize(log_alpha, u) # z(u)
+            b = tf.to_float(tf.stop_gradient(z > 0))
+            v = v_from_u(u, log_alpha, force_same, b, v_p)
+            z_tilde = reparameterize(log_alpha, v)
+
+            # loss function evaluations
+            f_b = loss_func(b, target)
+
+            # if we are relaxing the relaxation
+            if relaxed == "relaxation":
+                with tf.variable_scope("Q_func", reuse=reuse):
+                    sig_z = Q_func(z)
                 with tf.variable_scope("Q_func", reuse=True):
-                    q_z_tilde = Q_func(sig_z_tilde)[:, 0]
-                if relaxed == True:
-                    f_z = f_z + q_z
-                    f_z_tilde = f_z_tilde + q_z_tilde
-                elif relaxed == "super":
-                    f_z = q_z
-                    f_z_tilde = q_z_tilde
+                    sig_z_tilde = Q_func(z_tilde)
+                f_z = loss_func(sig_z, target)
+                f_z_tilde = loss_func(sig_z_tilde, target)
 
+            else:
+                # relaxation variables
+                batch_temp = tf.expand_dims(temperature, 0)
+                sig_z = concrete_relaxation(z, batch_temp)
+                sig_z_tilde = concrete_relaxation(z_tilde, batch_temp)
+
+                f_z = loss_func(sig_z, target)
+                f_z_tilde = loss_func(sig_z_tilde, target)
+
+                if relaxed != False:
+                    with tf.variable_scope("Q_func", reuse=reuse):
+                        q_z = Q_func(sig_z)[:, 0]
+                    with tf.variable_scope("Q_func", reuse=True):
+                        q_z_tilde = Q_func(sig_z_tilde)[:, 0]
+                    if relaxed == True:
+                        f_z = f_z + q_z
+                        f_z_tilde = f_z_tilde + q_z_tilde
+                    elif relaxed == "super":
+                        f_z = q_z
+                        f_z_tilde = q_z_tilde
+
+            # rebar construction
+            d_f_z_d_log_alpha = tf.gradients(f_z, log_alpha)[0]
+            d_f_z_tilde_d_log_alpha = tf.gradients(f_z_tilde, log_alpha)[0]
+#            d_log_pb_d_log_alpha = bernoulli_loglikelihood_derivitive(b, log_alpha)
+            d_log_pb_d_log_alpha = tf.gradients(bernoulli_loglikelihood(b, log_alpha), log_alpha)[0]
+            d_log_pz_d_log_alpha = tf.gradients(logistic_loglikelihood(z, log_alpha), log_alpha)[0]
+            # check shapes are alright
+            assert_same_shapes(d_f_z_d_log_alpha, d_f_z_tilde_d_log_alpha, d_log_pb_d_log_alpha, d_log_pz_d_log_alpha)
+            assert_same_shapes(f_b, f_z_tilde)
+            batch_eta = tf.expand_dims(eta, 0)
+            batch_f_b = tf.expand_dims(f_b, 1)
+            batch_f_z_tilde = tf.expand_dims(f_z_tilde, 1)
+            # do one of LAX, BAR, relaxed-REBAR, or REBAR
+            if LAX or BAR:
+                batch_f_z = tf.expand_dims(f_z, 1)
+                rebar = batch_f_b*d_log_pb_d_log_alpha - batch_eta*batch_f_z*d_log_pz_d_log_alpha + batch_eta*d_f_z_d_log_alpha
+#                rebar = (batch_f_b - batch_f_z) * d_log_pb_d_log_alpha + (d_f_z_d_log_alpha)
+            elif relaxed == "super":
+                rebar = (batch_f_b - batch_f_z_tilde) * d_log_pb_d_log_alpha + (d_f_z_d_log_alpha - d_f_z_tilde_d_log_alpha)
+            else:
+                rebar = (batch_f_b - batch_eta * batch_f_z_tilde) * d_log_pb_d_log_alpha + batch_eta * (d_f_z_d_log_alpha - d_f_z_tilde_d_log_alpha)
+            reinforce = batch_f_b * d_log_pb_d_log_alpha
+            return u, sig_z, f_b, f_z, f_z_tilde, rebar, reinforce
+
+        u, sig_z, f_b, f_z, f_z_tilde, rebar, reinforce = build_estimators()
 
         tf.summary.scalar("fb", tf.reduce_mean(f_b))
         tf.summary.scalar("fz", tf.reduce_mean(f_z))
@@ -223,28 +254,6 @@ def main(t=0.499, rand_seed=42, use_reinforce=False, relaxed=False, visualize=Fa
         loss = tf.reduce_mean(f_b)
         tf.summary.scalar("loss", loss)
 
-        # rebar construction
-        d_f_z_d_log_alpha = tf.gradients(f_z, log_alpha)[0]
-        d_f_z_tilde_d_log_alpha = tf.gradients(f_z_tilde, log_alpha)[0]
-#        d_log_pb_d_log_alpha = bernoulli_loglikelihood_derivitive(b, log_alpha)
-        d_log_pb_d_log_alpha = tf.gradients(bernoulli_loglikelihood(b, log_alpha), log_alpha)[0]
-        d_log_pz_d_log_alpha = tf.gradients(logistic_loglikelihood(z, log_alpha), log_alpha)[0]
-        # check shapes are alright
-        assert_same_shapes(d_f_z_d_log_alpha, d_f_z_tilde_d_log_alpha, d_log_pb_d_log_alpha, d_log_pz_d_log_alpha)
-        assert_same_shapes(f_b, f_z_tilde)
-        batch_eta = tf.expand_dims(eta, 0)
-        batch_f_b = tf.expand_dims(f_b, 1)
-        batch_f_z_tilde = tf.expand_dims(f_z_tilde, 1)
-        # do one of LAX, BAR, relaxed-REBAR, or REBAR
-        if LAX or BAR:
-            batch_f_z = tf.expand_dims(f_z, 1)
-            rebar = batch_f_b*d_log_pb_d_log_alpha - batch_eta*batch_f_z*d_log_pz_d_log_alpha + batch_eta*d_f_z_d_log_alpha
-#            rebar = (batch_f_b - batch_f_z) * d_log_pb_d_log_alpha + (d_f_z_d_log_alpha)
-        elif relaxed == "super":
-            rebar = (batch_f_b - batch_f_z_tilde) * d_log_pb_d_log_alpha + (d_f_z_d_log_alpha - d_f_z_tilde_d_log_alpha)
-        else:
-            rebar = (batch_f_b - batch_eta * batch_f_z_tilde) * d_log_pb_d_log_alpha + batch_eta * (d_f_z_d_log_alpha - d_f_z_tilde_d_log_alpha)
-        reinforce = batch_f_b * d_log_pb_d_log_alpha
         exact_gradient = tf.stop_gradient(tf.square(1 - target) - tf.square(-target)) * tf.nn.sigmoid(log_alpha)
         tf.summary.histogram("rebar", rebar)
         tf.summary.histogram("reinforce", reinforce)
@@ -298,6 +307,12 @@ def main(t=0.499, rand_seed=42, use_reinforce=False, relaxed=False, visualize=Fa
         tf.summary.histogram("estimator_diffs", est_diffs)
         summ_op = tf.summary.merge_all()
         summary_writer = tf.summary.FileWriter(TRAIN_DIR)
+        # estimator means and variances over many noise draws, in one sess.run each
+        n_variance_samples = 1000
+        if log_var:
+            log_var_stats = estimator_moments(lambda: build_estimators(reuse=True)[-2:], 100)
+        if test_bias:
+            test_bias_stats = estimator_moments(lambda: build_estimators(reuse=True)[-2:], n_variance_samples)
         sess.run(tf.global_variables_initializer())
         
         variances = []
@@ -331,37 +346,30 @@ def main(t=0.499, rand_seed=42, use_reinforce=False, relaxed=False, visualize=Fa
 
 
                 if log_var:
-                    grads = [sess.run([rebar, reinforce]) for i in tqdm(range(100))]
-                    rebars, reinforces = zip(*grads)
-                    re_m, re_v = np.mean(rebars), np.std(rebars)
-                    rf_m, rf_v = np.mean(reinforces), np.std(reinforces)
+                    (rb_mean, rb_var), (rf_mean, rf_var) = sess.run(log_var_stats)
+                    # same quantities as np.mean / np.std over the stacked draws: the std is pooled
+                    # over draws and latents, within-latent variance plus the spread of latent means
+                    re_m, re_v = np.mean(rb_mean), np.sqrt(np.mean(rb_var) + np.var(rb_mean))
+                    rf_m, rf_v = np.mean(rf_mean), np.sqrt(np.mean(rf_var) + np.var(rf_mean))
                     if use_reinforce:
                         variances.append(re_v)
                     print("Reinforce mean = {}, Reinforce std = {}".format(rf_m, rf_v))
                     print("Rebar mean     = {}, Rebar std     = {}".format(re_m, re_v))
 
                 if test_bias:
-                    n_variance_samples = 1000
-                    rebars = []
-                    reinforces = []
-                    for _ in tqdm(range(n_variance_samples)):
-                        rb, re = sess.run([rebar, reinforce])
-                        rebars.append(rb)
-                        reinforces.append(re)
-                    rebars = np.array(rebars)
-                    reinforces = np.array(reinforces)
-                    re_var = np.log(reinforces.var(axis=0))
-                    rb_var = np.log(rebars.var(axis=0))
+                    (rb_mean, rb_var), (re_mean, re_var) = sess.run(test_bias_stats)
+                    re_var = np.log(re_var)
+                    rb_var = np.log(rb_var)
                     if use_reinforce:
                       variances.append(np.mean(re_var))
                     else:
                       variances.append(np.mean(rb_var))
-                    diffs = np.abs(rebars.mean(axis=0) - reinforces.mean(axis=0))
+                    diffs = np.abs(rb_mean - re_mean)
                     sess.run([rebar_var.assign(rb_var), reinforce_var.assign(re_var), est_diffs.assign(diffs)])
                     print("rebar variance = {}".format(rb_var.mean()))
                     print("reinforce variance = {}".format(re_var.mean()))
-                    print("rebar     = {}".format(rebars.mean(axis=0)[0]))
-                    print("reinforce = {}\n".format(reinforces.mean(axis=0)[0]))
+                    print("rebar     = {}".format(rb_mean[0]))
+                    print("reinforce = {}\n".format(re_mean[0]))
 
                 if visualize == "f":
                     # run variance reduction operation
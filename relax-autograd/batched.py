@@ -0,0 +1,78 @@
+import autograd.numpy as np
+from autograd import make_vjp
+
+from relax import bernoulli_sample, control_variate_estimator, reduce_grads
+from profiling import profiled, stage, evaluate
+from optimizers import FlatParams, flat_adam, leaves
+
+# K independent RELAX problems stacked along a leading axis and optimized as
+# one array computation.  params have shape (K, D), log_temperature (K,),
+# surrogate weights (K, insize, outsize) and biases (K, outsize), and noise
+# (K, N, D).  The objective maps (K, N, D) samples to (K, N, 1) values, so
+# problems may have different targets.
+
+
+def stack_problems(structures):
+    # Stacks the leaves of K identically nested parameter structures.
+    stacked = iter([np.stack(group) for group in zip(*[list(leaves(s)) for s in structures])])
+    def rebuild(structure):
+        if isinstance(structure, (tuple, list)):
+            return type(structure)(rebuild(item) for item in structure)
+        return next(stacked)
+    return rebuild(structures[0])
+
+def batched_nn_predict(params, inputs):
+    for W, b in params:
+        outputs = np.matmul(inputs, W) + b[:, None, :]
+        inputs = np.maximum(0, outputs)
+    return outputs
+
+def batched_relax(params, est_params, noise_u, noise_v, func_vals):
+    params = params[:, None, :]  # broadcasts against the sample axis
+    log_temperature, nn_params = est_params
+    samples = bernoulli_sample(params, noise_u)
+
+    def surrogate(relaxed_samples):
+        return batched_nn_predict(nn_params, relaxed_samples)
+
+    return control_variate_estimator(params, np.reshape(log_temperature, (-1, 1, 1)), surrogate,
+                                     samples, func_vals, noise_u, noise_v)
+
+@profiled
+def batched_relax_all(params, est_params, noise_u, noise_v, f, reduce=False):
+    # Returns objective, gradients, and gradients of variance of gradients, all
+    # with a leading problem axis.  Problems are independent, so the gradient of
+    # the summed variances gives each problem its own d_var_d_est.  Under
+    # profile(), rows count samples over all K problems.
+    func_vals = evaluate(f, bernoulli_sample(params[:, None, :], noise_u))
+    var_vjp, grads = make_vjp(batched_relax, argnum=1)(params, est_params, noise_u, noise_v, func_vals)
+    with stage('vjp'):
+        d_var_d_est = var_vjp(2 * grads / grads.shape[1])
+    if reduce:
+        grads = reduce_grads(np.moveaxis(grads, 1, 0))
+    return func_vals, grads, d_var_d_est
+
+def optimize_batched(objective, init_combined_params, noise_sources, num_samples,
+                     num_iters=1000, step_size=0.1):
+    """Runs RELAX with Adam on K stacked problems at once.
+
+    noise_sources holds one NoiseSource per problem, so problems can have
+    different seeds.  Adam is elementwise, so one update of the stacked buffer
+    equals K independent updates.  Returns the final stacked parameters and
+    per-problem traces of shape (num_iters, K) for the mean objective and
+    temperature."""
+    traces = {'objective': [], 'temperature': []}
+
+    def combined_grad(combined_params, t):
+        params, est_params = combined_params
+        noise = [source(t, num_samples) for source in noise_sources]
+        noise_u, noise_v = np.stack([u for u, _ in noise]), np.stack([v for _, v in noise])
+        func_vals, (grad_mean, grad_sq), d_var_d_est = \
+            batched_relax_all(params, est_params, noise_u, noise_v, objective, reduce=True)
+        traces['objective'].append(np.mean(func_vals, axis=(1, 2)))
+        traces['temperature'].append(np.exp(est_params[0]))
+        return grad_mean, d_var_d_est
+
+    final_params = flat_adam(combined_grad, FlatParams(init_combined_params),
+                             step_size=step_size, num_iters=num_iters)
+    return final_params, {name: np.array(trace) for name, trace in traces.items()}
@@ -0,0 +1,184 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import argparse
+import gc
+import itertools
+import json
+import os
+import sys
+import time
+
+import autograd.numpy as np
+import autograd.numpy.random as npr
+from autograd import elementwise_grad
+from autograd.scipy.special import logit
+
+from relax import reinforce, concrete, rebar, rebar_all, relax_all, bernoulli_sample,\
+    init_nn_params, PhiloxNoise
+from profiling import profile, evaluate
+
+# Work-normalized benchmark of the Bernoulli estimators.  For every estimator,
+# dimension D, batch size and objective cost it measures throughput, the
+# variance of the mean gradient, and that variance times the wall time or the
+# objective rows it took.  Lower is better for the work-normalized numbers.
+# Results go to JSON, by default in the gitignored benchmark_results/ next to
+# this script.  With --baseline, they are also compared against a stored run,
+# and the exit status is 1 if throughput dropped by more than
+# --speed_tolerance or variance changed by more than --tolerance.  Throughput
+# is the best of --repeats timed passes over the steps of each case, since a
+# single pass can be slowed down by other processes.  Timings still vary far
+# more than the variances, which are fixed by the seed, so their tolerance is
+# looser:
+#
+#     python benchmark_estimators.py --output benchmark_results/baseline.json
+#     python benchmark_estimators.py --baseline benchmark_results/baseline.json
+
+DIMENSIONS = [10, 100]
+BATCH_SIZES = [10, 100, 1000]
+OBJECTIVE_COSTS = [0, 8]   # extra dense tanh layers applied to every row
+ESTIMATORS = ['reinforce', 'concrete', 'rebar', 'rebar_all', 'relax_all']
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'benchmark_results', 'benchmark_estimators.json')
+
+
+def make_objective(D, cost, rs):
+    # A rowwise objective whose per-row work grows with cost.
+    targets = np.linspace(0.2, 0.9, D)
+    weights = [rs.randn(D, D) / np.sqrt(D) for _ in range(cost)]
+    def objective(b):
+        h = b - targets
+        for W in weights:
+            h = np.tanh(np.dot(h, W))
+        return np.sum(h**2, axis=-1, keepdims=True)
+    return objective
+
+def make_estimator(name, params, objective, D):
+    # Returns estimator(noise_u, noise_v) -> per-sample gradients of shape (num_samples, D).
+    log_temperature, log_eta = np.log(0.5), np.log(0.3)
+    nn_params = init_nn_params(0.1, [D, 5, 1], npr.RandomState(0))
+    if name == 'reinforce':
+        return lambda u, v: reinforce(params, u, evaluate(objective, bernoulli_sample(params, u)))
+    if name == 'concrete':
+        return lambda u, v: elementwise_grad(concrete)(np.broadcast_to(params, np.shape(u)),
+                                                       log_temperature, u, objective)
+    if name == 'rebar':
+        return lambda u, v: rebar(params, (log_temperature, log_eta), u, v, objective)
+    if name == 'rebar_all':
+        return lambda u, v: rebar_all(params, (log_temperature, log_eta), u, v, objective)[1]
+    if name == 'relax_all':
+        return lambda u, v: relax_all(params, (log_temperature, nn_params), u, v, objective)[1]
+    raise ValueError("Unknown estimator {}".format(name))
+
+def setup_case(name, D, num_samples, cost):
+    rs = npr.RandomState(0)
+    params = logit(rs.rand(D))
+    objective = make_objective(D, cost, rs)
+    estimator = make_estimator(name, params, objective, D)
+    noise = PhiloxNoise(D, seed=0)
+    estimator(*noise(0, num_samples))  # warm up
+    return estimator, noise
+
+def time_pass(estimator, noise, num_samples, num_steps):
+    # Mean wall time per step of one pass over the steps, noise generation
+    # excluded.  As in timeit, garbage collection is off while timing.
+    total = 0.0
+    gc.collect()
+    gc.disable()
+    try:
+        for t in range(num_steps):
+            noise_u, noise_v = noise(t, num_samples)
+            start = time.perf_counter()
+            estimator(noise_u, noise_v)
+            total += time.perf_counter() - start
+    finally:
+        gc.enable()
+    return total / num_steps
+
+def run_case(name, D, num_samples, cost, num_steps, estimator, noise):
+    # Everything but throughput, which time_case fills in.
+    means = []
+    with profile(track_memory=False) as profiler:
+        for t in range(num_steps):
+            means.append(np.mean(estimator(*noise(t, num_samples)), axis=0))
+    with profile() as memory_profiler:
+        estimator(*noise(0, num_samples))
+
+    costs = profiler.total()
+    variance = float(np.sum(np.var(np.array(means), axis=0)))
+    objective_rows = costs.rows.get('objective', 0) / float(num_steps)
+    return {'estimator': name, 'D': D, 'num_samples': num_samples, 'objective_cost': cost,
+            'time_per_step': float('inf'),
+            'grad_variance': variance,
+            'objective_rows_per_step': objective_rows,
+            'var_x_objective_rows': variance * objective_rows,
+            'stage_times': {stage: t / num_steps for stage, t in costs.times.items()},
+            'peak_bytes': memory_profiler.total().peak_bytes}
+
+def time_case(result, estimator, noise, num_steps):
+    # Keeps the fastest pass seen so far for a case.
+    step_time = min(result['time_per_step'], time_pass(estimator, noise, result['num_samples'], num_steps))
+    result.update({'time_per_step': step_time,
+                   'samples_per_sec': result['num_samples'] / step_time,
+                   'var_x_time': result['grad_variance'] * step_time})
+
+def case_key(result):
+    return (result['estimator'], result['D'], result['num_samples'], result['objective_cost'])
+
+def compare(results, baseline, tolerance, speed_tolerance):
+    # Prints throughput and variance ratios against a baseline run, and returns
+    # the cases that regressed.
+    baseline = {case_key(result): result for result in baseline['results']}
+    regressions = []
+    print("\n{:<10} {:>4} {:>8} {:>5} {:>16} {:>14}".format(
+        "estimator", "D", "samples", "cost", "throughput ratio", "variance ratio"))
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None:
+            continue
+        speed = result['samples_per_sec'] / old['samples_per_sec']
+        variance = result['grad_variance'] / old['grad_variance']
+        regressed = speed < 1 - speed_tolerance or abs(variance - 1) > tolerance
+        print("{:<10} {:>4} {:>8} {:>5} {:>16.3f} {:>14.3f}{}".format(
+            *(case_key(result) + (speed, variance, "  REGRESSION" if regressed else ""))))
+        if regressed:
+            regressions.append(case_key(result))
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', help="JSON from an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative change in variance")
+    parser.add_argument('--speed_tolerance', type=float, default=0.5, help="allowed relative drop in throughput")
+    parser.add_argument('--num_steps', type=int, default=20)
+    parser.add_argument('--repeats', type=int, default=5, help="timed passes per case, the best one counts")
+    parser.add_argument('--estimators', nargs='+', default=ESTIMATORS, choices=ESTIMATORS)
+    args = parser.parse_args()
+
+    cases = list(itertools.product(args.estimators, DIMENSIONS, BATCH_SIZES, OBJECTIVE_COSTS))
+    setups = [setup_case(*case) for case in cases]
+    results = [run_case(*(case + (args.num_steps,) + setup)) for case, setup in zip(cases, setups)]
+    # Repeats go round all the cases, so a slow spell on the machine hits a
+    # few passes of many cases rather than every pass of one case.
+    for _ in range(args.repeats):
+        for result, setup in zip(results, setups):
+            time_case(result, *(setup + (args.num_steps,)))
+
+    print("{:<10} {:>4} {:>8} {:>5} {:>14} {:>12} {:>12} {:>14}".format(
+        "estimator", "D", "samples", "cost", "samples/sec", "variance", "var x time", "var x f rows"))
+    for result in results:
+        print("{:<10} {:>4} {:>8} {:>5} {:>14.1f} {:>12.3e} {:>12.3e} {:>14.3e}".format(
+            *(case_key(result) + (result['samples_per_sec'], result['grad_variance'],
+                                  result['var_x_time'], result['var_x_objective_rows']))))
+
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump({'num_steps': args.num_steps, 'repeats': args.repeats, 'results': results}, f, indent=2)
+    print("\nWrote {}".format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.speed_tolerance)
+        print("\n{} regression(s)".format(len(regressions)))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,43 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import autograd.numpy as np
+import autograd.numpy.random as npr
+from autograd.scipy.special import logit
+from scipy.stats import qmc
+
+from relax import reinforce, rebar, bernoulli_sample, reduce_grads,\
+    PhiloxNoise, AntitheticNoise, QMCNoise
+from exact import exact_objective_and_grad
+
+# Variance of the Monte Carlo mean gradient for each noise generator, scaled by
+# the number of objective evaluations that produced it.  Lower is better; for
+# i.i.d. noise the number is independent of num_samples.
+
+if __name__ == '__main__':
+    D = 10
+    num_steps = 200
+    params = logit(npr.RandomState(0).rand(D))
+
+    def objective(b):
+        return np.sum((b - np.linspace(0.2, 0.9, D))**2, axis=-1, keepdims=True)
+
+    estimators = {
+        'reinforce': lambda u, v: reinforce(params, u, objective(bernoulli_sample(params, u))),
+        'rebar':     lambda u, v: rebar(params, (np.log(1.0), np.log(0.3)), u, v, objective),
+    }
+    generators = [("iid", PhiloxNoise(D)), ("antithetic", AntitheticNoise(D)),
+                  ("sobol", QMCNoise(D)), ("halton", QMCNoise(D, engine=qmc.Halton))]
+    exact_grad = exact_objective_and_grad(objective, params)[1]
+
+    print("{:<10} {:<11} {:>8} {:>16} {:>12}".format(
+        "estimator", "noise", "samples", "var x evals", "mean error"))
+    for est_name, estimator in sorted(estimators.items()):
+        for num_samples in [16, 64, 256]:
+            for noise_name, noise in generators:
+                means = np.array([reduce_grads(estimator(*noise(t, num_samples)))[0]
+                                  for t in range(num_steps)])
+                var_per_eval = np.sum(np.var(means, axis=0)) * num_samples
+                error = np.max(np.abs(np.mean(means, axis=0) - exact_grad))
+                print("{:<10} {:<11} {:>8} {:>16.6f} {:>12.6f}".format(
+                    est_name, noise_name, num_samples, var_per_eval, error))
@@ -0,0 +1,45 @@
+from __future__ import absolute_import
+from __future__ import print_function
+import matplotlib.pyplot as plt
+
+import autograd.numpy as np
+import autograd.numpy.random as npr
+
+from relax import init_nn_params, PhiloxNoise
+from batched import stack_problems, optimize_batched
+
+if __name__ == '__main__':
+
+    # K restarts of the demo_relax problem with different targets, seeds,
+    # initial temperatures and surrogate inits, optimized together.
+    K = 8
+    D = 100
+    num_hidden_units = 5
+    num_samples = 10
+    rs = npr.RandomState(0)
+    targets = np.stack([np.linspace(0, 1, D)[::1 - 2 * (k % 2)] for k in range(K)])[:, None, :]
+    init_temperatures = np.linspace(0.5, 2.0, K)
+    problems = [(np.zeros(D), (np.log(init_temperatures[k]),
+                               init_nn_params(0.1, [D, num_hidden_units, 1], npr.RandomState(k))))
+                for k in range(K)]
+
+    def objective(b):
+        return np.sum((b - targets)**2, axis=-1, keepdims=True)
+
+    print("Optimizing {} problems...".format(K))
+    noise_sources = [PhiloxNoise(D, seed=k) for k in range(K)]
+    params, traces = optimize_batched(objective, stack_problems(problems), noise_sources,
+                                      num_samples, num_iters=2000, step_size=0.1)
+    for k in range(K):
+        print("Problem {} final objective {} temperature {}".format(
+            k, traces['objective'][-1, k], traces['temperature'][-1, k]))
+
+    fig = plt.figure(figsize=(8, 8), facecolor='white')
+    ax1 = fig.add_subplot(211, frameon=False)
+    ax2 = fig.add_subplot(212, frameon=False)
+    ax1.plot(traces['objective'])
+    ax1.set_ylabel('objective')
+    ax2.plot(traces['temperature'])
+    ax2.set_ylabel('temperature')
+    ax2.set_xlabel('iteration')
+    plt.show()
@@ -1,13 +1,16 @@
 from __future__ import absolute_import
 from __future__ import print_function
+import asyncio
+import sys
 import matplotlib.pyplot as plt
 
 import autograd.numpy as np
 import autograd.numpy.random as npr
 from autograd.scipy.special import expit
-from autograd.misc.optimizers import adam
 
 from relax import rebar_all
+from optimizers import FlatParams, flat_adam
+from relax_async import serve_objective, RPCObjective, rebar_all_async, adam_async
 
 if __name__ == '__main__':
 
@@ -21,15 +24,23 @@ if __name__ == '__main__':
 
     def mc_objective_and_var(combined_params, t):
         params, est_params = combined_params
-        params_rep = np.tile(params, (num_samples, 1))
         rs = npr.RandomState(t)
         noise_u = rs.rand(num_samples, D)
         noise_v = rs.rand(num_samples, D)
-        return rebar_all(params_rep, est_params, noise_u, noise_v, objective)
+        return rebar_all(params, est_params, noise_u, noise_v, objective, reduce=True)
+
+    async def mc_objective_and_var_async(combined_params, t, objective_async):
+        params, est_params = combined_params
+        rs = npr.RandomState(t)
+        noise_u = rs.rand(num_samples, D)
+        noise_v = rs.rand(num_samples, D)
+        return await rebar_all_async(params, est_params, noise_u, noise_v,
+                                     objective, objective_async,
+                                     num_chunks=num_samples, reduce=True)
 
     def combined_grad(combined_params, t):
-        obj_value, grad_obj, grad_var = mc_objective_and_var(combined_params, t)
-        return (np.mean(grad_obj, axis=0), grad_var)
+        obj_value, (grad_mean, grad_sq), grad_var = mc_objective_and_var(combined_params, t)
+        return (grad_mean, grad_var)
 
     # Set up figure.
     fig = plt.figure(figsize=(8, 8), facecolor='white')
@@ -49,7 +60,7 @@ if __name__ == '__main__':
         temperatures.append(np.exp(log_temperature))
         etas.append(np.exp(log_eta))
         if t % 10 == 0:
-            objective_val, grads, est_grads = mc_objective_and_var(combined_params, t)
+            objective_val, (grad_mean, grad_sq), est_grads = mc_objective_and_var(combined_params, t)
             print("Iteration {} objective {}".format(t, np.mean(objective_val)))
             ax1.cla()
             ax1.plot(expit(params), 'r')
@@ -69,6 +80,24 @@ if __name__ == '__main__':
             plt.draw()
             plt.pause(1.0/30.0)
 
+    async def optimize_async():
+        # Serves the objective from a local stand-in server with 20ms latency per
+        # call, and overlaps it with the estimator math.
+        server = await serve_objective(objective, latency=0.02)
+        objective_async = RPCObjective(*server.sockets[0].getsockname()[:2])
+
+        async def combined_grad_async(combined_params, t):
+            obj_value, (grad_mean, grad_sq), grad_var = \
+                await mc_objective_and_var_async(combined_params, t, objective_async)
+            return (grad_mean, grad_var)
+
+        await adam_async(combined_grad_async, init_params, step_size=0.1, num_iters=2000, callback=callback)
+        await objective_async.close()
+        server.close()
+
     print("Optimizing...")
-    adam(combined_grad, init_params, step_size=0.1, num_iters=2000, callback=callback)
+    if '--async' in sys.argv:
+        asyncio.run(optimize_async())
+    else:
+        flat_adam(combined_grad, FlatParams(init_params), step_size=0.1, num_iters=2000, callback=callback)
     plt.pause(10.0)
\ No newline at end of file
@@ -9,7 +9,7 @@ from autograd.scipy.special import expit
 from autograd import grad
 from autograd.misc.optimizers import adam
 
-from relax import bernoulli_sample, reinforce
+from relax import bernoulli_sample, reinforce, reduce_grads
 
 if __name__ == '__main__':
 
@@ -22,13 +22,12 @@ if __name__ == '__main__':
         return np.sum((b - np.linspace(0, 1, D))**2, axis=-1, keepdims=True)
 
     def mc_objective_and_var(params, t):
-        params_rep = np.tile(params, (num_samples, 1))
         rs = npr.RandomState(t)
         noise_u = rs.rand(num_samples, D)
-        samples = bernoulli_sample(params_rep, noise_u)
+        samples = bernoulli_sample(params, noise_u)
         objective_vals = objective(samples)
-        grads = reinforce(params_rep, noise_u, objective_vals)
-        return np.mean(objective_vals), np.mean(grads, axis=0), np.var(grads, axis=0)
+        grad_mean, grad_sq = reduce_grads(reinforce(params, noise_u, objective_vals))
+        return np.mean(objective_vals), grad_mean, grad_sq - grad_mean**2
 
     def obj_grads(params, t):
         obj_value, grads, grad_variances = mc_objective_and_var(params, t)
@@ -1,13 +1,18 @@
 from __future__ import absolute_import
 from __future__ import print_function
+import asyncio
+import sys
 import matplotlib.pyplot as plt
 
 import autograd.numpy as np
 import autograd.numpy.random as npr
 from autograd.scipy.special import expit, logit
-from autograd.misc.optimizers import adam
+from autograd.misc import flatten
 
-from relax import init_nn_params, nn_predict, relax_all
+from relax import init_nn_params, nn_predict, relax_all, surrogate_fit_grads
+from evaluators import ReplayBuffer
+from optimizers import FlatParams, flat_adam
+from relax_async import serve_objective, RPCObjective, relax_all_async, adam_async
 
 def make_one_d(f, d, full_d_input):
     def oned(one_d_input):
@@ -35,17 +40,34 @@ if __name__ == '__main__':
     def objective(b):
         return np.sum((b - np.linspace(0, 1, D))**2, axis=-1, keepdims=True)
 
+    # With --replay, every (b, f(b)) pair is kept and reused to regularize the surrogate.
+    replay_buffer = ReplayBuffer(objective, 10000, D)
+    replay_weight = 0.01
+
     def mc_objective_and_var(combined_params, t):
         params, est_params = combined_params
-        params_rep = np.tile(params, (num_samples, 1))
         rs = npr.RandomState(t)
         noise_u = rs.rand(num_samples, D)
         noise_v = rs.rand(num_samples, D)
-        return relax_all(params_rep, est_params, noise_u, noise_v, objective)
+        f = replay_buffer if '--replay' in sys.argv else objective
+        return relax_all(params, est_params, noise_u, noise_v, f, reduce=True)
+
+    async def mc_objective_and_var_async(combined_params, t, objective_async):
+        params, est_params = combined_params
+        rs = npr.RandomState(t)
+        noise_u = rs.rand(num_samples, D)
+        noise_v = rs.rand(num_samples, D)
+        return await relax_all_async(params, est_params, noise_u, noise_v,
+                                     objective_async, num_chunks=num_samples, reduce=True)
 
     def combined_grad(combined_params, t):
-        obj_value, grad_obj, grad_var = mc_objective_and_var(combined_params, t)
-        return (np.mean(grad_obj, axis=0), grad_var)
+        obj_value, (grad_mean, grad_sq), grad_var = mc_objective_and_var(combined_params, t)
+        if '--replay' in sys.argv:
+            fit_grads = surrogate_fit_grads(combined_params[1], *replay_buffer.sample(100, rs),
+                                            weight=replay_weight)
+            flat_grad_var, unflatten = flatten(grad_var)
+            grad_var = unflatten(flat_grad_var + flatten(fit_grads)[0])
+        return (grad_mean, grad_var)
 
     # Set up figure.
     fig = plt.figure(figsize=(8, 8), facecolor='white')
@@ -66,7 +88,7 @@ if __name__ == '__main__':
         log_temperature, nn_params = est_params
         temperatures.append(np.exp(log_temperature))
         if t % 10 == 0:
-            objective_val, grads, est_grads = mc_objective_and_var(combined_params, t)
+            objective_val, (grad_mean, grad_sq), est_grads = mc_objective_and_var(combined_params, t)
             print("Iteration {} objective {}".format(t, np.mean(objective_val)))
             ax1.cla()
             ax1.plot(expit(params), 'r')
@@ -78,7 +100,7 @@ if __name__ == '__main__':
             ax2.set_ylabel('average gradient')
             ax2.set_xlabel('parameter index')
             ax3.cla()
-            ax3.plot(np.var(grads), 'b')
+            ax3.plot(grad_sq - grad_mean**2, 'b')
             ax3.set_ylabel('gradient variance')
             ax3.set_xlabel('parameter index')
             ax4.cla()
@@ -96,6 +118,24 @@ if __name__ == '__main__':
             plt.draw()
             plt.pause(1.0/30.0)
 
+    async def optimize_async():
+        # Serves the objective from a local stand-in server with 20ms latency per
+        # call, and overlaps it with the estimator math.
+        server = await serve_objective(objective, latency=0.02)
+        objective_async = RPCObjective(*server.sockets[0].getsockname()[:2])
+
+        async def combined_grad_async(combined_params, t):
+            obj_value, (grad_mean, grad_sq), grad_var = \
+                await mc_objective_and_var_async(combined_params, t, objective_async)
+            return (grad_mean, grad_var)
+
+        await adam_async(combined_grad_async, init_combined_params, step_size=0.1, num_iters=2000, callback=callback)
+        await objective_async.close()
+        server.close()
+
     print("Optimizing...")
-    adam(combined_grad, init_combined_params, step_size=0.1, num_iters=2000, callback=callback)
+    if '--async' in sys.argv:
+        asyncio.run(optimize_async())
+    else:
+        flat_adam(combined_grad, FlatParams(init_combined_params), step_size=0.1, num_iters=2000, callback=callback)
     plt.pause(10.0)
@@ -0,0 +1,164 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count, shared_memory
+
+import numpy as np
+
+# Wrappers around an expensive black-box objective f.  Each wrapper is itself
+# a drop-in objective: pass it anywhere relax.py expects f.
+
+
+############### Memoizing cache ############
+
+class CachedObjective(object):
+    """Memoizes f on binary samples, keyed by their bit-packed rows.
+
+    A batch is deduplicated first, f is called once on the unique rows that
+    are not cached, and results are scattered back.  The cache keeps at most
+    max_size entries, evicting the least recently used.  Non-binary inputs
+    (e.g. relaxed samples in REBAR's control variate) and empty batches
+    bypass the cache."""
+    def __init__(self, f, max_size=100000):
+        self.f = f
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, samples):
+        if not (isinstance(samples, np.ndarray) and samples.dtype == bool) or len(samples) == 0:
+            return self.f(samples)
+        if samples.ndim == 1:  # a single sample
+            return self(samples[None])[0]
+        packed = np.packbits(samples, axis=-1)
+        unique_rows, first_index, inverse = np.unique(
+            packed, axis=0, return_index=True, return_inverse=True)
+        keys = [row.tobytes() for row in unique_rows]
+        missing = [i for i, key in enumerate(keys) if key not in self.cache]
+        self.misses += len(missing)
+        self.hits += len(samples) - len(missing)
+        if missing:
+            new_vals = self.f(samples[first_index[missing]])
+            for i, val in zip(missing, new_vals):
+                self.cache[keys[i]] = val
+        for key in keys:
+            self.cache.move_to_end(key)
+        unique_vals = np.stack([self.cache[key] for key in keys])
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return unique_vals[inverse.reshape(-1)]
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+############### Replay buffer ##############
+
+class ReplayBuffer(object):
+    """Fixed-capacity ring buffer of (b, f(b)) pairs seen by the estimators.
+
+    Calling the buffer evaluates f and records every binary sample it sees, so
+    it is a drop-in f for relax_all.  Samples are stored bit-packed and values
+    as float32; once full, the oldest pairs are overwritten."""
+    def __init__(self, f, capacity, D):
+        self.f = f
+        self.capacity = capacity
+        self.D = D
+        self.samples = np.zeros((capacity, (D + 7) // 8), dtype=np.uint8)
+        self.func_vals = np.zeros(capacity, dtype=np.float32)
+        self.position = 0
+        self.size = 0
+
+    def __call__(self, samples):
+        func_vals = self.f(samples)
+        if isinstance(samples, np.ndarray) and samples.dtype == bool:
+            self.add(samples, func_vals)
+        return func_vals
+
+    def __len__(self):
+        return self.size
+
+    def add(self, samples, func_vals):
+        samples, func_vals = samples[-self.capacity:], np.reshape(func_vals, -1)[-self.capacity:]
+        rows = (self.position + np.arange(len(samples))) % self.capacity
+        self.samples[rows] = np.packbits(samples, axis=-1)
+        self.func_vals[rows] = func_vals
+        self.position = (self.position + len(samples)) % self.capacity
+        self.size = min(self.size + len(samples), self.capacity)
+
+    def sample(self, num_samples, rs):
+        # Returns float samples of shape (num_samples, D) and values of shape (num_samples, 1).
+        rows = rs.randint(self.size, size=num_samples)
+        samples = np.unpackbits(self.samples[rows], axis=-1, count=self.D).astype(np.float64)
+        return samples, self.func_vals[rows, None].astype(np.float64)
+
+############### Process pool ###############
+
+def evaluate_shard(f, samples_spec, results_spec, start, stop):
+    # Runs in a worker: reads rows [start, stop) of the shared sample matrix
+    # and writes f of them into the same rows of the shared result matrix.
+    samples_shm, samples = attach_shared_array(*samples_spec)
+    results_shm, results = attach_shared_array(*results_spec)
+    try:
+        results[start:stop] = np.reshape(f(samples[start:stop]), (stop - start, -1))
+    finally:
+        del samples, results
+        samples_shm.close()
+        results_shm.close()
+
+def attach_shared_array(name, shape, dtype):
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+def create_shared_array(shape, dtype):
+    shm = shared_memory.SharedMemory(create=True, size=max(1, int(np.prod(shape)) * np.dtype(dtype).itemsize))
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+class ParallelObjective(object):
+    """Evaluates f on shards of a (num_samples, D) sample matrix in a process pool.
+
+    Samples and results are exchanged through multiprocessing.shared_memory,
+    so only the shard bounds are pickled.  f must be picklable (a module-level
+    function) and return output_dim values per row.  Results come back in row
+    order.  Inputs that are not plain arrays, such as autograd-traced relaxed
+    samples in REBAR, are evaluated in-process so they can be differentiated."""
+    def __init__(self, f, num_workers=None, num_shards=None, output_dim=1):
+        self.f = f
+        self.num_workers = num_workers or cpu_count()
+        self.num_shards = num_shards or self.num_workers
+        self.output_dim = output_dim
+        self.executor = ProcessPoolExecutor(self.num_workers)
+
+    def __call__(self, samples):
+        if not isinstance(samples, np.ndarray):
+            return self.f(samples)
+        num_samples = samples.shape[0]
+        samples_shm, shared_samples = create_shared_array(samples.shape, samples.dtype)
+        results_shm, shared_results = create_shared_array((num_samples, self.output_dim), np.float64)
+        try:
+            shared_samples[...] = samples
+            bounds = np.linspace(0, num_samples, min(self.num_shards, num_samples) + 1).astype(int)
+            samples_spec = (samples_shm.name, samples.shape, samples.dtype)
+            results_spec = (results_shm.name, shared_results.shape, shared_results.dtype)
+            futures = [self.executor.submit(evaluate_shard, self.f, samples_spec, results_spec, start, stop)
+                       for start, stop in zip(bounds[:-1], bounds[1:])]
+            for future in futures:
+                future.result()
+            return shared_results.copy()
+        finally:
+            del shared_samples, shared_results
+            for shm in (samples_shm, results_shm):
+                shm.close()
+                shm.unlink()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,46 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.special import expit
+
+# Exact expectation E_p(b|theta)[f(b)] and its gradient wrt logit theta, by
+# enumerating all 2^D binary configurations in chunks.  Used as ground truth
+# for bias checks of the Monte Carlo estimators in relax.py.
+
+
+def configurations(start, stop, D):
+    # Rows are the binary expansions of start, ..., stop - 1, one bit per dimension.
+    codes = np.arange(start, stop, dtype=np.int64)
+    return ((codes[:, None] >> np.arange(D)) & 1).astype(np.float64)
+
+def exact_chunk(f, params, start, stop):
+    # Returns (log_scale, sum w f, sum w f b) over one chunk of configurations,
+    # where w = p(b) / exp(log_scale) keeps the weights in a stable range.
+    samples = configurations(start, stop, len(params))
+    logprobs = np.dot(samples, params) - np.sum(np.logaddexp(0, params))
+    log_scale = np.max(logprobs)
+    weighted_vals = np.reshape(f(samples), -1) * np.exp(logprobs - log_scale)
+    return log_scale, np.sum(weighted_vals), np.dot(weighted_vals, samples)
+
+def exact_objective_and_grad(f, params, chunk_size=2**16, num_workers=1):
+    """Exact E[f(b)] and d/d params E[f(b)], with b_d ~ Bernoulli(expit(params_d)).
+
+    f maps a (num_configurations, D) array to one value per row.  Chunks are
+    spread over num_workers processes when num_workers > 1, in which case f
+    must be picklable."""
+    num_configurations = 2 ** len(params)
+    bounds = [(start, min(start + chunk_size, num_configurations))
+              for start in range(0, num_configurations, chunk_size)]
+    starts, stops = zip(*bounds)
+    if num_workers > 1:
+        with ProcessPoolExecutor(num_workers) as executor:
+            chunks = list(executor.map(exact_chunk, [f] * len(bounds), [params] * len(bounds), starts, stops))
+    else:
+        chunks = list(map(exact_chunk, [f] * len(bounds), [params] * len(bounds), starts, stops))
+    log_scales, sums, weighted_sums = map(np.array, zip(*chunks))
+    scales = np.exp(log_scales - np.max(log_scales))
+    total = np.dot(scales, sums)
+    weighted_total = np.dot(scales, weighted_sums)
+    norm = np.exp(np.max(log_scales))
+    # grad of E[f] is E[f(b) (b - theta)], the score function of each Bernoulli.
+    return norm * total, norm * (weighted_total - expit(params) * total)
@@ -0,0 +1,75 @@
+import numpy as np
+
+# Optimizers over a single contiguous parameter buffer.  autograd's adam
+# flattens and unflattens the nested (params, (log_temperature, nn_params))
+# structure on every iteration; here the nested structure is a set of views
+# into one flat buffer that is updated in place.
+
+
+def leaves(structure):
+    if isinstance(structure, (tuple, list)):
+        for item in structure:
+            for leaf in leaves(item):
+                yield leaf
+    else:
+        yield structure
+
+def build_views(structure, buffer, offset=0):
+    # Returns structure with every leaf replaced by a view into buffer.
+    if isinstance(structure, (tuple, list)):
+        items = []
+        for item in structure:
+            view, offset = build_views(item, buffer, offset)
+            items.append(view)
+        return type(structure)(items), offset
+    shape = np.shape(structure)
+    size = int(np.prod(shape))
+    return buffer[offset:offset + size].reshape(shape), offset + size
+
+
+class FlatParams(object):
+    """Nested parameters stored in one contiguous float64 buffer.
+
+    value has the same nesting of tuples and lists as the structure passed in,
+    with every array or scalar replaced by a zero-copy view into buffer, so
+    in-place updates of buffer are visible through value."""
+    def __init__(self, structure):
+        self.buffer = np.concatenate([np.ravel(leaf) for leaf in leaves(structure)]).astype(np.float64)
+        self.structure = structure
+        self.value = self.views(self.buffer)
+
+    def views(self, buffer):
+        # The same layout over any other buffer of the same size, e.g. gradients.
+        return build_views(self.structure, buffer)[0]
+
+    def write(self, structure_views, nested):
+        # Copies a nested structure into views returned by self.views, without allocating.
+        for view, leaf in zip(leaves(structure_views), leaves(nested)):
+            view[...] = leaf
+
+
+def flat_adam(grad, flat_params, callback=None, num_iters=100,
+              step_size=0.001, b1=0.9, b2=0.999, eps=10**-8):
+    """Adam as in autograd.misc.optimizers.adam, updating flat_params.buffer in place.
+
+    grad(params, i) and callback(params, i, grads) see nested structures of
+    views, so keep copies of anything that should outlive an iteration."""
+    x = flat_params.buffer
+    g, m, v, mhat, vhat = [np.zeros_like(x) for _ in range(5)]
+    params, grads = flat_params.value, flat_params.views(g)
+    for i in range(num_iters):
+        flat_params.write(grads, grad(params, i))
+        if callback: callback(params, i, grads)
+        # Same operations in the same order as autograd's adam, so results match exactly.
+        m *= b1                                      # First  moment estimate.
+        m += np.multiply(g, 1 - b1, out=mhat)
+        v *= b2                                      # Second moment estimate.
+        np.square(g, out=vhat)
+        v += np.multiply(vhat, 1 - b2, out=vhat)
+        np.divide(m, 1 - b1**(i + 1), out=mhat)      # Bias correction.
+        np.divide(v, 1 - b2**(i + 1), out=vhat)
+        mhat *= step_size
+        np.sqrt(vhat, out=vhat)
+        vhat += eps
+        x -= np.divide(mhat, vhat, out=mhat)
+    return params
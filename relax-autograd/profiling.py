@@ -0,0 +1,171 @@
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+
+import numpy as np
+
+# Opt-in cost accounting for the estimators in relax.py.  Inside
+#
+#     with profile() as profiler:
+#         relax_all(...)
+#
+# every top-level estimator call appends a CostReport to profiler.reports,
+# and profiler.total() sums them over an optimization run.  Reports count
+# calls and rows of the objective f and of the surrogate, and time each
+# stage exclusive of the stages nested in it.  Rows are the values a call
+# returns, one per sample, so a stacked (K, N, D) batch counts K * N rows.  Backward passes run inside
+# the vjp stage.  Outside a profile block every hook is a single check of
+# an empty list.
+#
+# Counts are per kind, not per function evaluation.  REBAR's surrogate is
+# eta * f, so each relaxed call is one surrogate call wrapping one objective
+# call: a REBAR step reports 3 objective and 2 surrogate calls for 3 actual
+# evaluations of f.  calls['objective'] is always the number of times f ran;
+# do not add the kinds together.  Times have no such overlap, since the
+# nested objective stage is excluded from the surrogate's time.
+
+STAGES = ('sampling', 'objective', 'surrogate', 'vjp', 'estimator')
+
+_profilers = []
+
+
+class CostReport(object):
+    """Costs of one estimator call, or of several added together."""
+    def __init__(self, name):
+        self.name = name
+        self.num_calls = 1
+        self.calls = {}       # 'objective', 'surrogate', 'surrogate_backward' -> count, kinds may nest
+        self.rows = {}        # same keys -> rows evaluated
+        self.times = dict.fromkeys(STAGES, 0.0)
+        self.peak_bytes = 0   # largest rise in traced memory during a call
+
+    def __add__(self, other):
+        total = CostReport(self.name if self.name == other.name else 'total')
+        total.num_calls = self.num_calls + other.num_calls
+        for key in set(self.calls) | set(other.calls):
+            total.calls[key] = self.calls.get(key, 0) + other.calls.get(key, 0)
+            total.rows[key] = self.rows.get(key, 0) + other.rows.get(key, 0)
+        total.times = {key: self.times[key] + other.times[key] for key in STAGES}
+        total.peak_bytes = max(self.peak_bytes, other.peak_bytes)
+        return total
+
+    @property
+    def time(self):
+        return sum(self.times.values())
+
+    def as_dict(self):
+        return {'name': self.name, 'num_calls': self.num_calls, 'calls': dict(self.calls),
+                'rows': dict(self.rows), 'times': dict(self.times), 'time': self.time,
+                'peak_bytes': self.peak_bytes}
+
+
+class Profiler(object):
+    def __init__(self, track_memory=True):
+        self.track_memory = track_memory
+        self.reports = []
+        self.report = None    # report of the call in progress
+        self.stack = []       # [stage, start time] of open stages
+
+    def total(self):
+        return sum(self.reports[1:], self.reports[0]) if self.reports else CostReport('total')
+
+    def enter(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            self.charge(now)
+        self.stack.append([name, now])
+
+    def exit(self):
+        now = time.perf_counter()
+        self.charge(now)
+        self.stack.pop()
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def charge(self, now):
+        name, start = self.stack[-1]
+        self.report.times[name] += now - start
+        self.stack[-1][1] = now
+
+
+@contextmanager
+def profile(track_memory=True):
+    """Collects a CostReport per estimator call.  With track_memory, peak bytes
+    come from tracemalloc, which slows the timed code down."""
+    profiler = Profiler(track_memory)
+    started_tracing = track_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    _profilers.append(profiler)
+    try:
+        yield profiler
+    finally:
+        _profilers.remove(profiler)
+        if started_tracing:
+            tracemalloc.stop()
+
+def active():
+    # The profiler of the estimator call in progress, if any.
+    return _profilers[-1] if _profilers and _profilers[-1].report is not None else None
+
+@contextmanager
+def stage(name):
+    profiler = active()
+    if profiler is None:
+        yield
+        return
+    profiler.enter(name)
+    try:
+        yield
+    finally:
+        profiler.exit()
+
+def staged(name):
+    # Decorator version of stage.
+    def decorator(fun):
+        @wraps(fun)
+        def wrapped(*args, **kwargs):
+            if active() is None:
+                return fun(*args, **kwargs)
+            with stage(name):
+                return fun(*args, **kwargs)
+        return wrapped
+    return decorator
+
+def count(kind, rows):
+    profiler = active()
+    if profiler is not None:
+        profiler.report.calls[kind] = profiler.report.calls.get(kind, 0) + 1
+        profiler.report.rows[kind] = profiler.report.rows.get(kind, 0) + rows
+
+def profiled(estimator):
+    # Marks a top-level estimator: the outermost call under profile() gets its
+    # own CostReport, and nested estimator calls are charged to it.
+    @wraps(estimator)
+    def wrapped(*args, **kwargs):
+        if not _profilers or _profilers[-1].report is not None:
+            return estimator(*args, **kwargs)
+        profiler = _profilers[-1]
+        profiler.report = CostReport(estimator.__name__)
+        if profiler.track_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        try:
+            with stage('estimator'):
+                return estimator(*args, **kwargs)
+        finally:
+            if profiler.track_memory:
+                profiler.report.peak_bytes = tracemalloc.get_traced_memory()[1] - baseline
+            profiler.reports.append(profiler.report)
+            profiler.report = None
+    return wrapped
+
+@profiled
+def evaluate(f, inputs, kind='objective'):
+    # Calls f on a batch, counted and timed as kind.  Called outside an
+    # estimator, e.g. for the func_vals passed to reinforce, it gets its own report.
+    with stage(kind):
+        outputs = f(inputs)
+        count(kind, np.size(outputs))
+        return outputs
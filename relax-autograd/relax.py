@@ -1,8 +1,17 @@
+from contextlib import contextmanager
+
 import autograd.numpy as np
 import autograd.numpy.random as npr
+from numpy.random import Generator, Philox, default_rng
+from scipy.stats import qmc
+
+from autograd.scipy.special import expit, logit, logsumexp
+from autograd import grad, elementwise_grad, make_vjp
+from autograd.tracer import isbox
+from autograd.misc import flatten
+from autograd.misc.optimizers import adam
 
-from autograd.scipy.special import expit, logit
-from autograd import elementwise_grad, value_and_grad, make_vjp
+from profiling import profiled, staged, stage, count, evaluate
 
 
 def heaviside(z):
@@ -13,74 +22,299 @@ def softmax(z, log_temperature):
     return expit(z / temperature)
 
 def logistic_sample(noise, mu=0, sigma=1):
-    return mu + logit(noise) * sigma
+    return mu + noise_logit(noise) * sigma
 
 def logistic_logpdf(x, mu=0, scale=1):
     y = (x - mu) / (2 * scale)
     return -2 * np.logaddexp(y, -y) - np.log(scale)
 
+@staged('sampling')
 def bernoulli_sample(logit_theta, noise):
-    return logit(noise) < logit_theta
+    return noise_logit(noise) < logit_theta
 
+@staged('sampling')
 def relaxed_bernoulli_sample(logit_theta, noise, log_temperature):
     return softmax(logistic_sample(noise, expit(logit_theta)), log_temperature)
 
+@staged('sampling')
 def conditional_noise(logit_theta, samples, noise):
     # Computes p(u|b), where b = H(z), z = logit_theta + logit(noise), p(u) = U(0, 1)
     uprime = expit(-logit_theta)  # u' = 1 - theta
+    samples = samples.astype(noise.dtype)
     return samples * (noise * (1 - uprime) + uprime) + (1 - samples) * noise * uprime
 
 def bernoulli_logprob(logit_theta, targets):
-    # log Bernoulli(targets | theta), targets are 0 or 1.
-    return -np.logaddexp(0, -logit_theta * (targets * 2 - 1))
+    # log Bernoulli(targets | theta), targets are 0 or 1.  logaddexp(0, x) is
+    # a stable softplus, and the signs are cast so that integer targets do not
+    # promote float32 logits to float64.  Either argument may be a Python scalar.
+    signs = np.asarray(targets * 2 - 1, dtype=getattr(logit_theta, 'dtype', np.float64))
+    return -np.logaddexp(0, -logit_theta * signs)
+
+def reduce_grads(grads):
+    # Mean and second moment over samples of per-sample gradients, in place of
+    # the full (num_samples, D) array.
+    num_samples = grads.shape[0]
+    return np.sum(grads, axis=0) / num_samples, np.einsum('n...,n...->...', grads, grads) / num_samples
+
+
+############### Precision ##################
+# Estimators compute in the dtype of their inputs.  The *_all functions and
+# init_nn_params cast to a compute dtype, float64 unless set globally with
+# `with precision(np.float32):` or per call with dtype=np.float32, which halves
+# every (num_samples, D) array.  Uniforms are clipped into the open unit
+# interval before taking logs, since a float64 u cast to float32 can round to
+# 0 or 1 and give infinite logistic or Gumbel noise.  Inside the interval
+# 1 - u is exact for u >= 1/2, so logit(u) is as accurate in float32 as the
+# uniforms themselves.
+
+_compute_dtype = [np.float64]
+
+@contextmanager
+def precision(dtype):
+    _compute_dtype.append(dtype)
+    try:
+        yield
+    finally:
+        _compute_dtype.pop()
+
+def compute_dtype(dtype=None):
+    return np.dtype(dtype or _compute_dtype[-1])
+
+def cast(structure, dtype=None):
+    # Casts every array or scalar in a nested structure, without copying what
+    # already has the right dtype.  Values being differentiated pass through.
+    if isbox(structure):
+        return structure
+    if isinstance(structure, (tuple, list)):
+        return type(structure)(cast(item, dtype) for item in structure)
+    return np.asarray(structure, dtype=compute_dtype(dtype))
+
+def clip_unit(noise):
+    finfo = np.finfo(noise.dtype)
+    return np.clip(noise, finfo.tiny, 1 - finfo.epsneg)
+
+def noise_logit(noise):
+    return logit(clip_unit(noise))
+
+
+############### Noise ######################
+
+class NoiseSource(object):
+    """Base class for the noise_u / noise_v generators consumed by the estimators.
+
+    Subclasses implement uniform(stream, step, samples, dims), returning rows
+    samples = (start, stop) and columns dims = (start, stop) of stream 0 (u) or
+    1 (v) at an optimization step.  Any block can be regenerated on demand and
+    deterministically, so chunked, parallel or distributed callers never need
+    to materialize, cache or ship the full (num_samples, D) arrays."""
+    def __init__(self, D, seed=0):
+        self.D = D
+        self.seed = seed
+
+    def noise_u(self, step, samples, dims=None):
+        return self.uniform(0, step, samples, dims)
+
+    def noise_v(self, step, samples, dims=None):
+        return self.uniform(1, step, samples, dims)
+
+    def __call__(self, step, num_samples):
+        # Full noise_u, noise_v for one optimization step.
+        return self.noise_u(step, (0, num_samples)), self.noise_v(step, (0, num_samples))
+
+
+class PhiloxNoise(NoiseSource):
+    """I.i.d. uniforms from a counter-based Philox generator."""
+    def draws(self, stream, step, offset, count):
+        # Philox produces 4 draws per counter increment.
+        bit_generator = Philox(key=[self.seed, step], counter=[offset // 4, 0, stream, 0])
+        return Generator(bit_generator).random(offset % 4 + count)[offset % 4:]
+
+    def uniform(self, stream, step, samples, dims=None):
+        # Element (n, d) of a stream at a given step is draw number n * D + d.
+        (start, stop), (d_start, d_stop) = samples, dims or (0, self.D)
+        if (d_start, d_stop) == (0, self.D):
+            return self.draws(stream, step, start * self.D, (stop - start) * self.D).reshape(-1, self.D)
+        rows = [self.draws(stream, step, n * self.D + d_start, d_stop - d_start)
+                for n in range(start, stop)]
+        return np.array(rows).reshape(stop - start, d_stop - d_start)
+
+
+class AntitheticNoise(PhiloxNoise):
+    """Antithetic pairs: every odd row is (1 - u, 1 - v) of the even row before it."""
+    def uniform(self, stream, step, samples, dims=None):
+        start, stop = samples
+        base = PhiloxNoise.uniform(self, stream, step, (start // 2, (stop + 1) // 2), dims)
+        rows = np.arange(start, stop)
+        pairs = base[rows // 2 - start // 2]
+        return np.where(rows[:, None] % 2 == 1, 1 - pairs, pairs)
+
+
+class QMCNoise(NoiseSource):
+    """Randomized quasi-Monte Carlo uniforms.  Row n of (u, v) is point n of a
+    2D-dimensional scrambled Sobol (or Halton) sequence, re-scrambled every step
+    so each step's estimate stays unbiased.  Use powers of two for Sobol."""
+    def __init__(self, D, seed=0, engine=qmc.Sobol):
+        super(QMCNoise, self).__init__(D, seed)
+        self.engine = engine
+
+    def uniform(self, stream, step, samples, dims=None):
+        (start, stop), (d_start, d_stop) = samples, dims or (0, self.D)
+        sampler = self.engine(2 * self.D, scramble=True, seed=default_rng([self.seed, step]))
+        if start > 0:
+            sampler.fast_forward(start)
+        return sampler.random(stop - start)[:, stream * self.D + d_start:stream * self.D + d_stop]
 
 
 ############### REINFORCE ##################
 
+@profiled
 def reinforce(params, noise, func_vals):
+    params = np.broadcast_to(params, np.shape(noise))  # per-sample gradients
     samples = bernoulli_sample(params, noise)
-    return func_vals * elementwise_grad(bernoulli_logprob)(params, samples)
+    with stage('vjp'):
+        return func_vals * elementwise_grad(bernoulli_logprob)(params, samples)
 
 
 ############### CONCRETE ###################
 
+@profiled
 def concrete(params, log_temperature, noise, f):
     relaxed_samples = relaxed_bernoulli_sample(params, noise, log_temperature)
-    return f(relaxed_samples)
+    return evaluate(f, relaxed_samples)
 
 
 ############### REBAR ######################
 
-def rebar(params, est_params, noise_u, noise_v, f):
+def leave_one_out_mean(values):
+    # For every row, the mean of values over all other rows.
+    return (np.sum(values, axis=0, keepdims=True) - values) / (values.shape[0] - 1)
+
+def control_variate_estimator(params, log_temperature, surrogate, samples,
+                              func_vals, noise_u, noise_v, leave_one_out=False, d_logprob=None):
+    # Shared REBAR/RELAX gradient given the hard samples b = H(z) and f(b).
+    # The relaxed and conditional relaxed samples each get exactly one
+    # surrogate forward/backward pass, and f itself is never called here.
+    # With leave_one_out, the rows are samples for the same params, and each
+    # row's residual f(b) - c(z tilde) is also baselined by the mean residual of
+    # the other rows, as in RLOO/VIMCO.  The other rows are independent of this
+    # row's b, so this stays unbiased and costs no extra evaluations.
+    # d_logprob, the score of the samples, is computed here unless passed in.
+    params = np.broadcast_to(params, np.shape(noise_u))  # per-sample gradients
+
+    def surrogate_relaxed(params):
+        return evaluate(surrogate, relaxed_bernoulli_sample(params, noise_u, log_temperature), 'surrogate')
+
+    def surrogate_cond(params):
+        cond_noise = conditional_noise(params, samples, noise_v)  # z tilde
+        return evaluate(surrogate, relaxed_bernoulli_sample(params, cond_noise, log_temperature), 'surrogate')
+
+    with stage('vjp'):
+        grad_surrogate = elementwise_grad(surrogate_relaxed)(params)
+        count('surrogate_backward', np.size(func_vals))  # one value per row, stacked or not
+        cond_vjp, f_cond = make_vjp(surrogate_cond)(params)
+        grad_surrogate_cond = cond_vjp(np.ones_like(f_cond))
+        count('surrogate_backward', np.size(func_vals))
+        if d_logprob is None:
+            d_logprob = elementwise_grad(bernoulli_logprob)(params, samples)
+    residuals = func_vals - f_cond
+    if leave_one_out:
+        residuals = residuals - leave_one_out_mean(residuals)
+    return residuals * d_logprob + grad_surrogate - grad_surrogate_cond
+
+@profiled
+def rebar(params, est_params, noise_u, noise_v, f, func_vals=None):
     log_temperature, log_eta = est_params
     eta = np.exp(log_eta)
     samples = bernoulli_sample(params, noise_u)
-
-    def concrete_cond(params):
-        cond_noise = conditional_noise(params, samples, noise_v)
-        return concrete(params, log_temperature, cond_noise, f)
-
-    grad_concrete = elementwise_grad(concrete)(params, log_temperature, noise_u, f)
-    f_cond, grad_concrete_cond = value_and_grad(concrete_cond)(params)
-    return reinforce(params, noise_u, f(samples) - eta * f_cond) + \
-           eta * (grad_concrete - grad_concrete_cond)
-
-def rebar_all(params, est_params, noise_u, noise_v, f):
+    if func_vals is None:
+        func_vals = evaluate(f, samples)
+    # f nested in the surrogate: each relaxed call counts as both objective and surrogate
+    return control_variate_estimator(params, log_temperature, lambda x: eta * evaluate(f, x),
+                                     samples, func_vals, noise_u, noise_v)
+
+@profiled
+def rebar_all(params, est_params, noise_u, noise_v, f, reduce=False, dtype=None):
     # Returns objective, gradients, and gradients of variance of gradients.
-    func_vals = f(bernoulli_sample(params, noise_u))
-    var_vjp, grads = make_vjp(rebar, argnum=1)(params, est_params, noise_u, noise_v, f)
-    d_var_d_est = var_vjp(2 * grads / grads.shape[0])
-    return func_vals, grads, d_var_d_est
+    # f is evaluated exactly once on the hard samples and reused everywhere.
+    params, est_params, noise_u, noise_v = cast((params, est_params, noise_u, noise_v), dtype)
+    func_vals = cast(evaluate(f, bernoulli_sample(params, noise_u)), dtype)
+    var_vjp, grads = make_vjp(rebar, argnum=1)(params, est_params, noise_u, noise_v, f, func_vals)
+    with stage('vjp'):
+        d_var_d_est = var_vjp(2 * grads / grads.shape[0])
+    return func_vals, reduce_grads(grads) if reduce else grads, d_var_d_est
+
+
+class OptimalEta(object):
+    """Running estimate of the variance-minimizing REBAR eta.
+
+    REBAR is a - eta * c, with a = f(b) d log p(b) the REINFORCE term and c the
+    zero-mean control variate.  Per dimension, E[(a - eta c)^2] is minimized at
+    eta = E[a c] / E[c^2]; per_dimension=False pools the dimensions into one
+    eta, as in rebar.  The moments are moving averages over past steps, so the
+    eta used at a step never depends on that step's samples."""
+    def __init__(self, decay=0.9, per_dimension=True, init_eta=1.0):
+        self.decay = decay
+        self.per_dimension = per_dimension
+        self.init_eta = init_eta
+        self.cross, self.control = None, None
+
+    @property
+    def eta(self):
+        if self.cross is None:
+            return self.init_eta
+        return self.cross / np.maximum(self.control, np.finfo(np.result_type(self.control)).tiny)
+
+    def update(self, reinforce_terms, control_terms):
+        cross = np.mean(reinforce_terms * control_terms, axis=0)
+        control = np.mean(control_terms**2, axis=0)
+        if not self.per_dimension:
+            cross, control = np.sum(cross), np.sum(control)
+        if self.cross is None:
+            self.cross, self.control = cross, control
+        else:
+            self.cross = self.decay * self.cross + (1 - self.decay) * cross
+            self.control = self.decay * self.control + (1 - self.decay) * control
+
+def rebar_terms(params, log_temperature, samples, d_logprob, noise_u, noise_v, f, func_vals):
+    # REINFORCE term a and control variate c, such that rebar = a - eta * c,
+    # given the hard samples, their score d log p(b) and f(b).
+    reinforce_terms = func_vals * d_logprob
+    # f nested in the surrogate: each relaxed call counts as both objective and surrogate
+    rebar_eta_one = control_variate_estimator(params, log_temperature, lambda x: evaluate(f, x), samples,
+                                              func_vals, noise_u, noise_v, d_logprob=d_logprob)
+    return reinforce_terms, reinforce_terms - rebar_eta_one
+
+@profiled
+def rebar_optimal_eta_all(params, log_temperature, noise_u, noise_v, f, eta_stats,
+                          reduce=False, dtype=None):
+    # rebar_all with eta taken from eta_stats, an OptimalEta, instead of being
+    # learned.  Returns objective, gradients, and the gradient of the variance
+    # of gradients wrt log_temperature only, then updates eta_stats.
+    params, log_temperature, noise_u, noise_v = cast((params, log_temperature, noise_u, noise_v), dtype)
+    samples = bernoulli_sample(params, noise_u)
+    func_vals = cast(evaluate(f, samples), dtype)
+    with stage('vjp'):
+        d_logprob = elementwise_grad(bernoulli_logprob)(np.broadcast_to(params, np.shape(noise_u)), samples)
+    eta = cast(eta_stats.eta, dtype)
+    terms = lambda log_temperature: np.stack(rebar_terms(params, log_temperature, samples, d_logprob,
+                                                         noise_u, noise_v, f, func_vals))
+    terms_vjp, (reinforce_terms, control_terms) = make_vjp(terms)(log_temperature)
+    grads = reinforce_terms - eta * control_terms
+    with stage('vjp'):
+        cotangent = 2 * grads / grads.shape[0]
+        d_var_d_log_temperature = terms_vjp(np.stack([cotangent, -eta * cotangent]))
+    eta_stats.update(reinforce_terms, control_terms)
+    return func_vals, reduce_grads(grads) if reduce else grads, d_var_d_log_temperature
 
 
 ############### RELAX ######################
 # Uses a neural network for control variate instead of original objective
 
-def init_nn_params(scale, layer_sizes, rs=npr.RandomState(0)):
+def init_nn_params(scale, layer_sizes, rs=npr.RandomState(0), dtype=None):
     """Build a list of (weights, biases) tuples, one for each layer."""
-    return [(rs.randn(insize, outsize) * scale,   # weight matrix
-             rs.randn(outsize) * scale)           # bias vector
-            for insize, outsize in zip(layer_sizes[:-1], layer_sizes[1:])]
+    return cast([(rs.randn(insize, outsize) * scale,   # weight matrix
+                  rs.randn(outsize) * scale)           # bias vector
+                 for insize, outsize in zip(layer_sizes[:-1], layer_sizes[1:])], dtype)
 
 relu = lambda x: np.maximum(0, x)
 
@@ -90,25 +324,190 @@ def nn_predict(params, inputs):
         inputs = relu(outputs)
     return outputs
 
-def relax(params, est_params, noise_u, noise_v, func_vals):
+@profiled
+def relax(params, est_params, noise_u, noise_v, func_vals, leave_one_out=False):
     samples = bernoulli_sample(params, noise_u)
     log_temperature, nn_params = est_params
 
     def surrogate(relaxed_samples):
         return nn_predict(nn_params, relaxed_samples)
 
+    return control_variate_estimator(params, log_temperature, surrogate,
+                                     samples, func_vals, noise_u, noise_v, leave_one_out)
+
+@profiled
+def relax_all(params, est_params, noise_u, noise_v, f, reduce=False, dtype=None, leave_one_out=False):
+    # Returns objective, gradients, and gradients of variance of gradients.
+    # leave_one_out adds the multi-sample baseline of control_variate_estimator.
+    if leave_one_out and np.shape(noise_u)[0] < 2:
+        raise ValueError("leave_one_out needs at least 2 samples")
+    params, est_params, noise_u, noise_v = cast((params, est_params, noise_u, noise_v), dtype)
+    func_vals = cast(evaluate(f, bernoulli_sample(params, noise_u)), dtype)
+    var_vjp, grads = make_vjp(relax, argnum=1)(params, est_params, noise_u, noise_v, func_vals, leave_one_out)
+    with stage('vjp'):
+        d_var_d_est = var_vjp(2 * grads / grads.shape[0])
+    return func_vals, reduce_grads(grads) if reduce else grads, d_var_d_est
+
+
+def surrogate_regression_loss(nn_params, samples, func_vals):
+    # Squared error of the surrogate on stored (b, f(b)) pairs.  Fitting it
+    # reuses past objective values to warm up or regularize the control variate.
+    return np.mean((nn_predict(nn_params, samples) - func_vals)**2)
+
+def surrogate_fit_grads(est_params, samples, func_vals, weight=1.0):
+    # Gradient of weight * surrogate_regression_loss, shaped like d_var_d_est for relax_all.
+    loss = lambda est_params: weight * surrogate_regression_loss(est_params[1], samples, func_vals)
+    return grad(loss)(est_params)
+
+def warm_up_surrogate(nn_params, replay_buffer, num_iters=100, batch_size=100,
+                      step_size=0.01, rs=npr.RandomState(0)):
+    # Fits the surrogate to buffered pairs with Adam, without calling the objective.
+    def loss_grad(nn_params, t):
+        return grad(surrogate_regression_loss)(nn_params, *replay_buffer.sample(batch_size, rs))
+    return adam(loss_grad, nn_params, step_size=step_size, num_iters=num_iters)
+
+############### Categorical ################
+# Counterparts of the Bernoulli estimators for K-way categorical latents.
+# params are logits of shape (D, K), noise has shape (N, D, K) and samples
+# are one-hot along the last axis.  f takes (N, D, K) inputs.
+
+def gumbel(noise):
+    return -np.log(-np.log(clip_unit(noise)))
+
+def log_softmax(logits):
+    return logits - logsumexp(logits, axis=-1, keepdims=True)
+
+def gumbel_softmax(z, log_temperature):
+    return np.exp(log_softmax(z / np.exp(log_temperature)))
+
+@staged('sampling')
+def categorical_sample(logits, noise):
+    # Gumbel-max: b = one_hot(argmax z), z = log p + Gumbel(noise)
+    z = log_softmax(logits) + gumbel(noise)
+    return z == np.max(z, axis=-1, keepdims=True)
+
+@staged('sampling')
+def relaxed_categorical_sample(logits, noise, log_temperature):
+    return gumbel_softmax(log_softmax(logits) + gumbel(noise), log_temperature)
+
+@staged('sampling')
+def conditional_gumbel(logits, samples, noise):
+    # Computes z tilde ~ p(z|b) with truncated Gumbels: the argmax is a standard
+    # Gumbel, and every other coordinate is a Gumbel truncated below it.
+    log_probs = log_softmax(logits)
+    samples = samples.astype(noise.dtype)  # np.where would return float64 gradients
+    top = gumbel(np.sum(samples * noise, axis=-1, keepdims=True))
+    others = -np.log(-np.log(clip_unit(noise)) * np.exp(-log_probs) + np.exp(-top))
+    return samples * top + (1 - samples) * others
+
+def categorical_logprob(logits, targets):
+    # log Categorical(targets | softmax(logits)), targets are one-hot.
+    return np.sum(targets * log_softmax(logits), axis=-1)
+
+def categorical_control_variate_estimator(params, log_temperature, surrogate, samples,
+                                          func_vals, noise_u, noise_v):
+    # Categorical version of control_variate_estimator, with the same costs.
+    params = np.broadcast_to(params, np.shape(noise_u))  # per-sample gradients
+
+    def surrogate_relaxed(params):
+        return evaluate(surrogate, relaxed_categorical_sample(params, noise_u, log_temperature), 'surrogate')
+
     def surrogate_cond(params):
-        cond_noise = conditional_noise(params, samples, noise_v)  # z tilde
-        return concrete(params, log_temperature, cond_noise, surrogate)
+        z_tilde = conditional_gumbel(params, samples, noise_v)
+        return evaluate(surrogate, gumbel_softmax(z_tilde, log_temperature), 'surrogate')
+
+    with stage('vjp'):
+        grad_surrogate = elementwise_grad(surrogate_relaxed)(params)
+        count('surrogate_backward', len(samples))
+        cond_vjp, f_cond = make_vjp(surrogate_cond)(params)
+        grad_surrogate_cond = cond_vjp(np.ones_like(f_cond))
+        count('surrogate_backward', len(samples))
+        d_logprob = elementwise_grad(categorical_logprob)(params, samples)
+    weights = np.reshape(func_vals - f_cond, (-1, 1, 1))
+    return weights * d_logprob + grad_surrogate - grad_surrogate_cond
+
+@profiled
+def categorical_rebar(params, est_params, noise_u, noise_v, f, func_vals=None):
+    log_temperature, log_eta = est_params
+    eta = np.exp(log_eta)
+    samples = categorical_sample(params, noise_u)
+    if func_vals is None:
+        func_vals = evaluate(f, samples)
+    # f nested in the surrogate: each relaxed call counts as both objective and surrogate
+    return categorical_control_variate_estimator(params, log_temperature, lambda x: eta * evaluate(f, x),
+                                                 samples, func_vals, noise_u, noise_v)
+
+@profiled
+def categorical_rebar_all(params, est_params, noise_u, noise_v, f, reduce=False, dtype=None):
+    # Returns objective, gradients, and gradients of variance of gradients.
+    params, est_params, noise_u, noise_v = cast((params, est_params, noise_u, noise_v), dtype)
+    func_vals = cast(evaluate(f, categorical_sample(params, noise_u)), dtype)
+    var_vjp, grads = make_vjp(categorical_rebar, argnum=1)(params, est_params, noise_u, noise_v, f, func_vals)
+    with stage('vjp'):
+        d_var_d_est = var_vjp(2 * grads / grads.shape[0])
+    return func_vals, reduce_grads(grads) if reduce else grads, d_var_d_est
+
+@profiled
+def categorical_relax(params, est_params, noise_u, noise_v, func_vals):
+    samples = categorical_sample(params, noise_u)
+    log_temperature, nn_params = est_params
+
+    def surrogate(relaxed_samples):
+        # The surrogate sees the D one-hot relaxations flattened into one vector.
+        return nn_predict(nn_params, np.reshape(relaxed_samples, (np.shape(relaxed_samples)[0], -1)))
 
-    grad_surrogate = elementwise_grad(concrete)(params, log_temperature, noise_u, surrogate)
-    surrogate_cond, grad_surrogate_cond = value_and_grad(surrogate_cond)(params)
-    return reinforce(params, noise_u, func_vals - surrogate_cond) + \
-           grad_surrogate - grad_surrogate_cond
+    return categorical_control_variate_estimator(params, log_temperature, surrogate,
+                                                 samples, func_vals, noise_u, noise_v)
 
-def relax_all(params, est_params, noise_u, noise_v, f):
+@profiled
+def categorical_relax_all(params, est_params, noise_u, noise_v, f, reduce=False, dtype=None):
     # Returns objective, gradients, and gradients of variance of gradients.
-    func_vals = f(bernoulli_sample(params, noise_u))
-    var_vjp, grads = make_vjp(relax, argnum=1)(params, est_params, noise_u, noise_v, func_vals)
-    d_var_d_est = var_vjp(2 * grads / grads.shape[0])
-    return func_vals, grads, d_var_d_est
+    params, est_params, noise_u, noise_v = cast((params, est_params, noise_u, noise_v), dtype)
+    func_vals = cast(evaluate(f, categorical_sample(params, noise_u)), dtype)
+    var_vjp, grads = make_vjp(categorical_relax, argnum=1)(params, est_params, noise_u, noise_v, func_vals)
+    with stage('vjp'):
+        d_var_d_est = var_vjp(2 * grads / grads.shape[0])
+    return func_vals, reduce_grads(grads) if reduce else grads, d_var_d_est
+
+############### Streaming Monte Carlo ######
+
+def merge_moments(count_a, mean_a, m2_a, count_b, mean_b, m2_b):
+    # Chan et al. parallel merge of running means and sums of squared deviations.
+    count = count_a + count_b
+    delta = mean_b - mean_a
+    mean = mean_a + delta * (count_b / count)
+    m2 = m2_a + m2_b + delta**2 * (count_a * count_b / count)
+    return count, mean, m2
+
+def streaming_mc(estimator, noise, num_samples, chunk_size=10000, step=0):
+    """Monte Carlo moments of an estimator over num_samples rows, chunk_size at a time.
+
+    estimator(noise_u, noise_v) returns per-sample gradients, or a
+    (func_vals, grads, d_var_d_est) tuple like rebar_all and relax_all.  noise
+    is a PhiloxNoise, so every chunk regenerates its own block and peak memory
+    depends on chunk_size only.  Per-sample values are identical to a single
+    unchunked call on the same noise.  Returns the mean objective, gradient
+    mean, gradient variance and d_var_d_est, with None for what the estimator
+    does not provide."""
+    count, grad_mean, grad_m2 = 0, 0.0, 0.0
+    func_mean, d_var_d_est, unflatten = None, None, None
+    for start in range(0, num_samples, chunk_size):
+        stop = min(start + chunk_size, num_samples)
+        out = estimator(noise.noise_u(step, (start, stop)), noise.noise_v(step, (start, stop)))
+        func_vals, grads, chunk_d_var = out if isinstance(out, tuple) else (None, out, None)
+        n, weight = stop - start, (stop - start) / stop
+        if func_vals is not None:
+            chunk_func_mean = np.mean(func_vals, axis=0)
+            func_mean = chunk_func_mean if start == 0 else \
+                func_mean + (chunk_func_mean - func_mean) * weight
+        if chunk_d_var is not None:
+            # d_var_d_est is a mean over samples, so chunks merge as a weighted mean.
+            flat_d_var, unflatten = flatten(chunk_d_var)
+            d_var_d_est = flat_d_var if start == 0 else \
+                d_var_d_est + (flat_d_var - d_var_d_est) * weight
+        chunk_mean = np.mean(grads, axis=0)
+        chunk_m2 = np.sum((grads - chunk_mean)**2, axis=0)
+        count, grad_mean, grad_m2 = merge_moments(count, grad_mean, grad_m2, n, chunk_mean, chunk_m2)
+    if unflatten is not None:
+        d_var_d_est = unflatten(d_var_d_est)
+    return func_mean, grad_mean, grad_m2 / count, d_var_d_est
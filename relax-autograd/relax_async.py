@@ -0,0 +1,141 @@
+import asyncio
+import struct
+
+import autograd.numpy as np
+from autograd import make_vjp
+from autograd.misc import flatten
+
+from relax import bernoulli_sample, reinforce, rebar, relax, reduce_grads
+
+# Async estimators for objectives that answer over a socket.  The objective
+# is an async callable f(samples) -> values.  The estimators start the
+# objective calls first, then compute the surrogate and concrete terms in a
+# worker thread while the results are still in flight.  This works because
+# rebar and relax are linear in func_vals.
+
+
+############### Objective over RPC #########
+# Wire format, both directions: a header of two uint32 (rows, cols) followed
+# by the array data.  Requests send uint8 samples; responses send float64 values.
+
+async def read_array(reader, dtype):
+    rows, cols = struct.unpack('!II', await reader.readexactly(8))
+    data = await reader.readexactly(rows * cols * np.dtype(dtype).itemsize)
+    return np.frombuffer(data, dtype=dtype).reshape(rows, cols)
+
+def write_array(writer, array, dtype):
+    array = np.asarray(array, dtype=dtype).reshape(len(array), -1)
+    writer.write(struct.pack('!II', *array.shape) + array.tobytes())
+
+async def serve_objective(f, host='127.0.0.1', port=0, latency=0.0):
+    """Stand-in objective server: evaluates f on every request, after an
+    optional artificial latency in seconds.  Returns the asyncio server."""
+    async def handle(reader, writer):
+        try:
+            while True:
+                samples = await read_array(reader, np.uint8)
+                await asyncio.sleep(latency)
+                write_array(writer, f(samples), np.float64)
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            writer.close()
+    return await asyncio.start_server(handle, host, port)
+
+
+class RPCObjective(object):
+    """Async objective evaluated by a server, over a small pool of persistent
+    connections.  At most max_concurrency requests are in flight at once.  A
+    request that fails or is cancelled closes its connection, which may be
+    dead or hold part of a reply, and the next request opens a new one."""
+    def __init__(self, host, port, max_concurrency=4):
+        self.host = host
+        self.port = port
+        self.max_concurrency = max_concurrency
+        self.connections = None  # (reader, writer) pairs, or None for a slot not yet connected
+        self.num_open = 0        # slots, connected or not
+
+    async def __call__(self, samples):
+        if self.connections is None:
+            self.connections = asyncio.Queue()
+        if self.connections.empty() and self.num_open < self.max_concurrency:
+            self.num_open += 1
+            self.connections.put_nowait(None)
+        connection = await self.connections.get()
+        writer = None
+        try:
+            reader, writer = connection or await asyncio.open_connection(self.host, self.port)
+            write_array(writer, samples, np.uint8)
+            await writer.drain()
+            values = await read_array(reader, np.float64)
+        except BaseException:
+            if writer is not None:
+                writer.close()
+            self.connections.put_nowait(None)
+            raise
+        self.connections.put_nowait((reader, writer))
+        return values
+
+    async def close(self):
+        while self.connections is not None and not self.connections.empty():
+            connection = self.connections.get_nowait()
+            if connection is not None:
+                connection[1].close()
+                await connection[1].wait_closed()
+        self.num_open = 0
+
+
+############### Async estimators ###########
+
+async def evaluate_async(f, samples, num_chunks=1):
+    # Splits the rows into chunks, evaluated concurrently, results in row order.
+    chunks = np.array_split(samples, min(num_chunks, len(samples)))
+    return np.concatenate(await asyncio.gather(*[f(chunk) for chunk in chunks]))
+
+async def estimator_all_async(estimator, params, est_params, noise_u, noise_v, f_async,
+                              num_chunks, reduce):
+    loop = asyncio.get_running_loop()
+    pending = asyncio.ensure_future(
+        evaluate_async(f_async, bernoulli_sample(params, noise_u), num_chunks))
+    # The control variate part of the gradient is the estimator at func_vals = 0.
+    surrogate_terms = loop.run_in_executor(None, estimator, est_params)
+    func_vals = await pending
+    var_vjp, cv_grads = await surrogate_terms
+    grads = cv_grads + reinforce(params, noise_u, func_vals)
+    d_var_d_est = var_vjp(2 * grads / grads.shape[0])
+    return func_vals, reduce_grads(grads) if reduce else grads, d_var_d_est
+
+async def relax_all_async(params, est_params, noise_u, noise_v, f_async, num_chunks=1,
+                          reduce=False):
+    # Returns objective, gradients, and gradients of variance of gradients.
+    estimator = lambda est_params: make_vjp(relax, argnum=1)(
+        params, est_params, noise_u, noise_v, 0.0)
+    return await estimator_all_async(estimator, params, est_params, noise_u, noise_v,
+                                     f_async, num_chunks, reduce)
+
+async def rebar_all_async(params, est_params, noise_u, noise_v, f, f_async, num_chunks=1,
+                          reduce=False):
+    # REBAR's control variate differentiates through f, so it needs a local
+    # differentiable f; only the hard samples are sent to f_async.
+    estimator = lambda est_params: make_vjp(rebar, argnum=1)(
+        params, est_params, noise_u, noise_v, f, 0.0)
+    return await estimator_all_async(estimator, params, est_params, noise_u, noise_v,
+                                     f_async, num_chunks, reduce)
+
+
+############### Async optimizer ############
+
+async def adam_async(grad, x, callback=None, num_iters=100,
+                     step_size=0.001, b1=0.9, b2=0.999, eps=10**-8):
+    """Adam as in autograd.misc.optimizers.adam, for a coroutine grad(x, i)."""
+    x, unflatten = flatten(x)
+    m = np.zeros(len(x))
+    v = np.zeros(len(x))
+    for i in range(num_iters):
+        g = flatten(await grad(unflatten(x), i))[0]
+        if callback: callback(unflatten(x), i, unflatten(g))
+        m = (1 - b1) * g      + b1 * m  # First  moment estimate.
+        v = (1 - b2) * (g**2) + b2 * v  # Second moment estimate.
+        mhat = m / (1 - b1**(i + 1))    # Bias correction.
+        vhat = v / (1 - b2**(i + 1))
+        x = x - step_size*mhat/(np.sqrt(vhat) + eps)
+    return unflatten(x)
@@ -0,0 +1,144 @@
+import numpy as np
+from scipy.special import expit, logit
+
+from sampling import fused_sample, unit_bounds
+
+# Autograd-free versions of reinforce, relax and relax_all from relax.py,
+# with every derivative written out by hand.  They take the same positional
+# arguments and return the same values for float64 inputs, so those three can
+# be swapped in for relax.py's.  Everything else stays autograd-only: the
+# dtype and leave_one_out options, init_nn_params, and the REBAR and
+# categorical estimators.  REBAR uses the black-box objective itself as the
+# control variate, which needs its gradient and Hessian.
+
+
+def noise_logit(noise):
+    # logit of uniforms clipped into the open unit interval, as in relax.noise_logit.
+    return logit(np.clip(noise, *unit_bounds(noise.dtype)))
+
+def bernoulli_sample(logit_theta, noise):
+    return noise_logit(noise) < logit_theta
+
+def bernoulli_logprob_grad(logit_theta, targets):
+    # d/d logit_theta of log Bernoulli(targets | theta)
+    return targets - expit(logit_theta)
+
+def relaxed_sample_grads(z, dz_dtheta, log_temperature, x=None):
+    # Returns x = sigma(z / temperature) with dx/dtheta, dx/dlog_temperature
+    # and d^2x/dtheta dlog_temperature, where z depends elementwise on theta.
+    # x may be passed in when it has already been computed.
+    temperature = np.exp(log_temperature)
+    if x is None:
+        x = expit(z / temperature)
+    dx_dz = x * (1 - x) / temperature
+    dx_dtheta = dx_dz * dz_dtheta
+    dx_dlogt = -dx_dz * z
+    d2x_dtheta_dlogt = -dx_dtheta * ((1 - 2 * x) * z / temperature + 1)
+    return x, dx_dtheta, dx_dlogt, d2x_dtheta_dlogt
+
+def conditional_noise_grad(logit_theta, samples, noise):
+    # Derivative wrt logit_theta of p(u|b) as in relax.conditional_noise.
+    uprime = expit(-logit_theta)  # u' = 1 - theta
+    d_uprime = -uprime * (1 - uprime)
+    return (samples * (1 - noise) + (1 - samples) * noise) * d_uprime
+
+def reduce_grads(grads):
+    # Mean and second moment over samples of per-sample gradients, as in relax.reduce_grads.
+    num_samples = grads.shape[0]
+    return np.sum(grads, axis=0) / num_samples, np.einsum('n...,n...->...', grads, grads) / num_samples
+
+
+############### MLP surrogate ##############
+
+def nn_predict(params, inputs):
+    return nn_forward(params, inputs)[0]
+
+def nn_forward(params, inputs):
+    # Returns outputs, plus the input and relu mask of every layer for the backward passes.
+    layer_inputs, masks = [], []
+    for W, b in params:
+        layer_inputs.append(inputs)
+        outputs = np.dot(inputs, W) + b
+        masks.append(outputs > 0)
+        inputs = outputs * masks[-1]
+    return outputs, layer_inputs, masks
+
+def nn_backward(params, masks):
+    # Backpropagates ones from the scalar output.  Returns d output / d preactivation
+    # for every layer, and d output / d inputs.
+    W_last = params[-1][0]
+    deltas = [np.ones((masks[-1].shape[0], W_last.shape[1]))]
+    for (W, _), mask in zip(params[:0:-1], masks[-2::-1]):
+        deltas.insert(0, np.dot(deltas[0], W.T) * mask)
+    return deltas, np.dot(deltas[0], params[0][0].T)
+
+def nn_param_grads(layer_inputs, deltas, cotangent):
+    # d/d params of sum(cotangent * outputs), cotangent has one entry per row.
+    return [(np.dot(a.T, cotangent * d), np.dot(cotangent.T, d)[0])
+            for a, d in zip(layer_inputs, deltas)]
+
+def nn_input_grad_param_grads(params, masks, deltas, directions):
+    # d/d params of sum(directions * d outputs / d inputs).  With relu activations
+    # this is a forward-mode pass of the directions through the masked linear
+    # chain, and the biases and inputs drop out (second derivatives vanish a.e.).
+    grads = []
+    tangent = directions
+    for (W, b), mask, d in zip(params, masks, deltas):
+        grads.append((np.dot(tangent.T, d), np.zeros_like(b)))
+        tangent = np.dot(tangent, W) * mask
+    return grads
+
+
+############### REINFORCE ##################
+
+def reinforce(params, noise, func_vals):
+    samples = bernoulli_sample(params, noise)
+    return func_vals * bernoulli_logprob_grad(params, samples)
+
+
+############### RELAX ######################
+
+def relax_terms(params, est_params, noise_u, noise_v, func_vals, var_grads=True, buffers=None):
+    # The sample stage runs in one fused pass, into buffers if given (a
+    # sampling.SampleBuffers reused across calls).
+    log_temperature, nn_params = est_params
+    buffers = fused_sample(params, noise_u, noise_v, log_temperature, buffers)
+    samples, cond_noise = buffers.b, buffers.cond_noise
+    theta = expit(params)
+    dz_dtheta = theta * (1 - theta)
+    # z tilde is theta + noise_logit(cond_noise), which is flat where the noise is clipped.
+    lo, hi = unit_bounds(cond_noise.dtype)
+    dlogit_dtheta = np.divide(conditional_noise_grad(params, samples, noise_v), cond_noise * (1 - cond_noise),
+                              out=np.zeros_like(cond_noise), where=(cond_noise > lo) & (cond_noise < hi))
+    dz_tilde_dtheta = dz_dtheta + dlogit_dtheta
+    x, dx, dx_dlogt, d2x = relaxed_sample_grads(buffers.z, dz_dtheta, log_temperature, buffers.x)
+    xc, dxc, dxc_dlogt, d2xc = relaxed_sample_grads(buffers.z_tilde, dz_tilde_dtheta, log_temperature, buffers.x_tilde)
+    f_cond, cond_inputs, cond_masks = nn_forward(nn_params, xc)
+    _, inputs, masks = nn_forward(nn_params, x)
+    deltas, grad_x = nn_backward(nn_params, masks)
+    cond_deltas, grad_xc = nn_backward(nn_params, cond_masks)
+    d_logprob = bernoulli_logprob_grad(params, samples)
+    grads = (func_vals - f_cond) * d_logprob + grad_x * dx - grad_xc * dxc
+    if not var_grads:
+        return grads, None
+
+    # Gradient of sum(grads^2) / N wrt est_params, holding the cotangent fixed.
+    cotangent = 2 * grads / grads.shape[0]
+    w_cond = -np.sum(cotangent * d_logprob, axis=1, keepdims=True)
+    d_log_temperature = np.sum(w_cond * grad_xc * dxc_dlogt) + \
+                        np.sum(cotangent * (grad_x * d2x - grad_xc * d2xc))
+    d_nn = nn_param_grads(cond_inputs, cond_deltas, w_cond)
+    d_nn_x = nn_input_grad_param_grads(nn_params, masks, deltas, cotangent * dx)
+    d_nn_xc = nn_input_grad_param_grads(nn_params, cond_masks, cond_deltas, cotangent * dxc)
+    d_nn = [(dW + dWx - dWxc, db + dbx - dbxc)
+            for (dW, db), (dWx, dbx), (dWxc, dbxc) in zip(d_nn, d_nn_x, d_nn_xc)]
+    return grads, (d_log_temperature, d_nn)
+
+def relax(params, est_params, noise_u, noise_v, func_vals, buffers=None):
+    return relax_terms(params, est_params, noise_u, noise_v, func_vals, var_grads=False, buffers=buffers)[0]
+
+def relax_all(params, est_params, noise_u, noise_v, f, reduce=False, buffers=None):
+    # Returns objective, gradients, and gradients of variance of gradients.
+    func_vals = f(bernoulli_sample(params, noise_u))
+    grads, d_var_d_est = relax_terms(params, est_params, noise_u, noise_v, func_vals, buffers=buffers)
+    return func_vals, reduce_grads(grads) if reduce else grads, d_var_d_est
@@ -0,0 +1,70 @@
+import numpy as np
+from scipy.special import expit, logit
+
+# Fused, allocation-free sampling stage for the Bernoulli estimators.  From
+# uniforms (u, v) it produces every sample-side quantity relax.py builds with
+# a chain of (num_samples, D) temporaries:
+#   b           = H(logit(u) < logit_theta)                (bernoulli_sample)
+#   cond_noise  = v conditioned on b                       (conditional_noise)
+#   z, z_tilde  = theta + logit(u), theta + logit(cond_noise)
+#   x, x_tilde  = sigma(z / temperature), sigma(z_tilde / temperature)
+# so x and x_tilde equal relaxed_bernoulli_sample on u and on cond_noise.
+# Everything is written into caller-provided buffers that are reused across
+# iterations.  The stage is a sequence of NumPy ufuncs with out= arguments.
+# A numba-compiled loop over the samples was tried and was no faster: the
+# logs and exps dominate, and they cost the same either way.
+
+
+class SampleBuffers(object):
+    """Preallocated outputs of fused_sample for noise of a given shape and dtype."""
+    def __init__(self, shape, dtype=np.float64):
+        self.b = np.empty(shape, dtype=bool)
+        self.cond_noise, self.z, self.z_tilde, self.x, self.x_tilde = \
+            [np.empty(shape, dtype=dtype) for _ in range(5)]
+
+    def matches(self, noise):
+        return self.z.shape == np.shape(noise) and self.z.dtype == noise.dtype
+
+
+def unit_bounds(dtype):
+    # Uniforms are clipped into the open unit interval, as in relax.clip_unit.
+    finfo = np.finfo(dtype)
+    return finfo.tiny, 1 - finfo.epsneg
+
+def fused_sample_numpy(logit_theta, noise_u, noise_v, temperature, out):
+    lo, hi = unit_bounds(out.z.dtype)
+    theta, uprime = expit(logit_theta), expit(-logit_theta)
+    scratch = out.x  # free until x itself is written
+
+    np.clip(noise_u, lo, hi, out=out.z)
+    logit(out.z, out=out.z)
+    np.less(out.z, logit_theta, out=out.b)
+    out.z += theta
+
+    # cond_noise = v (1 - u') + u' if b else v u', as in conditional_noise
+    np.multiply(noise_v, 1 - uprime, out=scratch)
+    scratch += uprime
+    np.multiply(noise_v, uprime, out=out.cond_noise)
+    np.copyto(out.cond_noise, scratch, where=out.b)
+
+    np.clip(out.cond_noise, lo, hi, out=out.z_tilde)
+    logit(out.z_tilde, out=out.z_tilde)
+    out.z_tilde += theta
+
+    for z, x in [(out.z, out.x), (out.z_tilde, out.x_tilde)]:
+        np.divide(z, temperature, out=x)
+        expit(x, out=x)
+    return out
+
+def fused_sample(logit_theta, noise_u, noise_v, log_temperature, out=None):
+    """Writes b, cond_noise, z, z_tilde, x and x_tilde for (noise_u, noise_v) into out.
+
+    out is a SampleBuffers of the noise's shape and dtype, allocated when not
+    given; pass the returned buffers back in on the next call to reuse them.
+    The only allocations per call are the D-sized theta vectors."""
+    if out is None or not out.matches(noise_u):
+        out = SampleBuffers(np.shape(noise_u), noise_u.dtype)
+    dtype = out.z.dtype
+    logit_theta = np.asarray(logit_theta, dtype=dtype)
+    temperature = dtype.type(np.exp(log_temperature))
+    return fused_sample_numpy(logit_theta, noise_u, noise_v, temperature, out)
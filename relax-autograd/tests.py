@@ -1,14 +1,29 @@
 from __future__ import absolute_import
 from __future__ import print_function
+import asyncio
 import itertools
 
 import autograd.numpy as np
 import autograd.numpy.random as npr
-from autograd.scipy.special import expit, logit
+from autograd.scipy.special import logit
 from autograd import grad
+from autograd.misc import flatten
+from autograd.misc.optimizers import adam
+from scipy.stats import qmc
 
-from relax import reinforce, concrete, bernoulli_sample,\
-    relax_all, init_nn_params, rebar, rebar_all
+from relax import reinforce, concrete, bernoulli_sample, relaxed_bernoulli_sample, conditional_noise,\
+    relax_all, init_nn_params, rebar, rebar_all, streaming_mc, bernoulli_logprob,\
+    PhiloxNoise, AntitheticNoise, QMCNoise, log_softmax, categorical_rebar_all, categorical_relax_all,\
+    precision, OptimalEta, rebar_optimal_eta_all, surrogate_regression_loss, surrogate_fit_grads, warm_up_surrogate,\
+    reduce_grads
+import relax_numpy
+from exact import exact_objective_and_grad
+from evaluators import CachedObjective, ParallelObjective, ReplayBuffer
+from relax_async import serve_objective, RPCObjective, relax_all_async, rebar_all_async, read_array, write_array
+from sampling import fused_sample
+from profiling import profile
+from batched import stack_problems, batched_relax_all
+from optimizers import FlatParams, flat_adam
 
 
 if __name__ == '__main__':
@@ -20,20 +35,14 @@ if __name__ == '__main__':
     def objective(b):
         return np.sum((b - np.linspace(0.2, 0.9, D))**2, axis=-1, keepdims=True)
 
-    def expected_objective(params):
-        lst = list(itertools.product([0.0, 1.0], repeat=D))
-        return sum([objective(np.array(b)) * np.prod([expit(params[i] * (b[i] * 2.0 - 1.0))
-                    for i in range(D)]) for b in lst])
-
     def mc(params, estimator):  # Simple Monte Carlo
         rs = npr.RandomState(0)
         noise = rs.rand(num_samples, D)
-        params_rep = np.tile(params, (num_samples, 1))
-        objective_vals = estimator(params_rep, noise, objective)
+        objective_vals = estimator(params, noise, objective)
         return np.mean(objective_vals, axis=0)
 
     print("Gradient estimators:")
-    print("Exact              : {}".format(grad(expected_objective)(params)))
+    print("Exact              : {}".format(exact_objective_and_grad(objective, params)[1]))
     print("Reinforce          : {}".format(mc(params, lambda p, n, o: reinforce(p, n, objective(bernoulli_sample(p, n))))))
     print("Concrete, temp = 1 : {}".format(grad(mc)(params, lambda p, n, o: concrete(p, np.log(1), n, o))))
     print("Rebar, temp = 1    : {}".format(mc(params, lambda p, n, o: rebar(p, (np.log(1.0),  np.log(0.3)), n, rs.rand(num_samples, D), o))))
@@ -46,16 +55,14 @@ if __name__ == '__main__':
         rs = npr.RandomState(0)
         noise_u = rs.rand(num_samples, D)
         noise_v = rs.rand(num_samples, D)
-        params_rep = np.tile(params, (num_samples, 1))
-        obj, grads, vargrads = method(params_rep, est_params, noise_u, noise_v, objective)
+        obj, grads, vargrads = method(params, est_params, noise_u, noise_v, objective)
         return np.sum(np.var(grads, axis=0))
 
     def var_grads(est_params, method):
         rs = npr.RandomState(0)
         noise_u = rs.rand(num_samples, D)
         noise_v = rs.rand(num_samples, D)
-        params_rep = np.tile(params, (num_samples, 1))
-        obj, grads, vargrads = method(params_rep, est_params, noise_u, noise_v, objective)
+        obj, grads, vargrads = method(params, est_params, noise_u, noise_v, objective)
         return vargrads
 
     print("\n\nGradient of variance of REBAR gradient:")
@@ -65,3 +72,258 @@ if __name__ == '__main__':
     print("\n\nGradient of variance of RELAX gradient:")
     print("Autodiff through variance : {}".format(grad(var_naive)((0.0, nn_params), relax_all)))
     print("Single-sample unbiased    : {}".format(var_grads((0.0, nn_params), relax_all)))
+
+    print("\n\nClosed-form RELAX (relax_numpy) vs autograd, max abs difference:")
+    rs = npr.RandomState(0)
+    noise_u = rs.rand(num_samples, D)
+    noise_v = rs.rand(num_samples, D)
+    _, grads, vargrads = relax_all(params, (0.0, nn_params), noise_u, noise_v, objective)
+    _, grads_np, vargrads_np = relax_numpy.relax_all(params, (0.0, nn_params), noise_u, noise_v, objective)
+    print("Gradients                 : {}".format(np.max(np.abs(grads - grads_np))))
+    print("Gradient of variance      : {}".format(np.max(np.abs(flatten(vargrads)[0] - flatten(vargrads_np)[0]))))
+    edge_noise_u, edge_noise_v = noise_u[:100].copy(), noise_v[:100].copy()
+    edge_noise_u[:2], edge_noise_v[2:4] = [[0.0], [1.0]], [[0.0], [1.0]]  # clipped before taking logits
+    edge_results = relax_all(params, (0.0, nn_params), edge_noise_u, edge_noise_v, objective)
+    edge_results_np = relax_numpy.relax_all(params, (0.0, nn_params), edge_noise_u, edge_noise_v, objective)
+    print("Noise at 0 and 1          : {}".format(max(np.max(np.abs(flatten(a)[0] - flatten(b)[0]))
+                                                      for a, b in zip(edge_results, edge_results_np))))
+    stacked_grads = rs.randn(10, 2, D)
+    print("reduce_grads on (N, 2, D) : {}".format(max(np.max(np.abs(a - b)) for a, b in
+                                                      zip(reduce_grads(stacked_grads), relax_numpy.reduce_grads(stacked_grads)))))
+
+    print("\n\nFused sampling kernel vs relax.py, max abs difference:")
+    buffers = fused_sample(params, noise_u, noise_v, 0.5)
+    cond_noise = conditional_noise(params, bernoulli_sample(params, noise_u), noise_v)
+    print("Samples                   : {}".format(np.sum(buffers.b != bernoulli_sample(params, noise_u))))
+    print("Conditional noise         : {}".format(np.max(np.abs(buffers.cond_noise - cond_noise))))
+    print("Relaxed samples           : {}".format(np.max(np.abs(buffers.x - relaxed_bernoulli_sample(params, noise_u, 0.5)))))
+    print("Conditional relaxed       : {}".format(np.max(np.abs(buffers.x_tilde - relaxed_bernoulli_sample(params, cond_noise, 0.5)))))
+    print("Buffers reused            : {}".format(fused_sample(params, noise_u, noise_v, 0.5, buffers) is buffers))
+
+    print("\n\nRELAX with a memoized objective:")
+    cached_objective = CachedObjective(objective)
+    _, grads_cached, _ = relax_all(params, (0.0, nn_params), noise_u, noise_v, cached_objective)
+    print("Max abs difference        : {}".format(np.max(np.abs(grads - grads_cached))))
+    print("Hits / misses             : {} / {}".format(cached_objective.hits, cached_objective.misses))
+    empty_samples, single_sample = np.zeros((0, D), dtype=bool), bernoulli_sample(params, noise_u[0])
+    print("Empty batch               : {} (f gives {})".format(cached_objective(empty_samples).shape,
+                                                               objective(empty_samples).shape))
+    print("Single (D,) sample        : {} (f gives {})".format(cached_objective(single_sample),
+                                                               objective(single_sample)))
+
+    print("\n\nReplay buffer of (b, f(b)) pairs recorded during RELAX:")
+    replay_buffer = ReplayBuffer(objective, 1000, D)
+    relax_all(params, (0.0, nn_params), noise_u, noise_v, replay_buffer)
+    replay_samples, replay_vals = replay_buffer.sample(1000, npr.RandomState(0))
+    print("Max relative error of f(b): {} (float32 eps {})".format(
+        np.max(np.abs(replay_vals - objective(replay_samples)) / objective(replay_samples)), np.finfo(np.float32).eps))
+    configs = np.array(list(itertools.product([False, True], repeat=D)))
+    ring_buffer = ReplayBuffer(objective, 5, D)
+    ring_buffer.add(configs[:6], np.arange(6))
+    ring_buffer.add(configs[6:], np.arange(6, 8))
+    ring_samples, ring_vals = ring_buffer.sample(100, npr.RandomState(0))
+    print("Oldest rows overwritten   : {}".format(sorted(set(ring_vals[:, 0])) == list(range(3, 8)) and
+                                                 np.array_equal(ring_samples, configs[ring_vals[:, 0].astype(int)])))
+    fit_grads = surrogate_fit_grads((0.0, nn_params), replay_samples, replay_vals)
+    print("Fit grads vs loss gradient: {}".format(np.max(np.abs(
+        flatten(fit_grads[1])[0] - flatten(grad(surrogate_regression_loss)(nn_params, replay_samples, replay_vals))[0]))))
+    warm_nn_params = warm_up_surrogate(nn_params, replay_buffer, num_iters=300)
+    print("Surrogate loss, warm-up   : {} -> {}".format(surrogate_regression_loss(nn_params, replay_samples, replay_vals),
+                                                        surrogate_regression_loss(warm_nn_params, replay_samples, replay_vals)))
+
+    print("\n\nRELAX and REBAR with a process-pool objective, max abs difference:")
+    with ParallelObjective(objective, num_workers=2, num_shards=4) as parallel_objective:
+        for name, method, est_params in [("Rebar", rebar_all, (0.0, np.log(0.3))),
+                                         ("Relax", relax_all, (0.0, nn_params))]:
+            results = method(params, est_params, noise_u, noise_v, objective)
+            results_parallel = method(params, est_params, noise_u, noise_v, parallel_objective)
+            print("{:<26}: {}".format(name, max(np.max(np.abs(flatten(a)[0] - flatten(b)[0]))
+                                                for a, b in zip(results, results_parallel))))
+
+    print("\n\nAsync RELAX and REBAR against a local objective server vs sync, max abs difference:")
+    async def async_results():
+        server = await serve_objective(objective)
+        rpc_objective = RPCObjective(*server.sockets[0].getsockname()[:2])
+        try:
+            return [await rebar_all_async(params, (0.0, np.log(0.3)), noise_u, noise_v,
+                                          objective, rpc_objective, num_chunks=4),
+                    await relax_all_async(params, (0.0, nn_params), noise_u, noise_v,
+                                          rpc_objective, num_chunks=4)]
+        finally:
+            await rpc_objective.close()
+            server.close()
+            await server.wait_closed()
+    for name, results, results_async in zip(["Rebar", "Relax"],
+            [rebar_all(params, (0.0, np.log(0.3)), noise_u, noise_v, objective),
+             relax_all(params, (0.0, nn_params), noise_u, noise_v, objective)],
+            asyncio.run(async_results())):
+        print("{:<26}: {}".format(name, max(np.max(np.abs(flatten(a)[0] - flatten(b)[0]))
+                                            for a, b in zip(results, results_async))))
+
+    print("\n\nAsync RELAX after the objective server dropped every connection:")
+    async def dropped_connection_results():
+        server_writers = []
+        async def handle(reader, writer):  # serve_objective's handler, keeping its connections
+            server_writers.append(writer)
+            try:
+                while True:
+                    write_array(writer, objective(await read_array(reader, np.uint8)), np.float64)
+                    await writer.drain()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                writer.close()
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        rpc_objective = RPCObjective(*server.sockets[0].getsockname()[:2])
+        relax_async = lambda: relax_all_async(params, (0.0, nn_params), noise_u, noise_v, rpc_objective, num_chunks=4)
+        try:
+            await relax_async()
+            for writer in server_writers:
+                writer.close()
+            try:
+                await relax_async()
+                error = None
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                error = type(e).__name__
+            return error, await relax_async()
+        finally:
+            await rpc_objective.close()
+            server.close()
+            await server.wait_closed()
+    error, results_async = asyncio.run(dropped_connection_results())
+    print("Call on dropped connection: {}".format(error))
+    print("Next call vs sync         : {}".format(max(np.max(np.abs(flatten(a)[0] - flatten(b)[0])) for a, b in
+        zip(relax_all(params, (0.0, nn_params), noise_u, noise_v, objective), results_async))))
+
+    print("\n\nBatched RELAX on 4 stacked problems vs relax_all per problem, max abs difference:")
+    K = 4
+    rs = npr.RandomState(0)
+    batch_targets = rs.rand(K, 1, D)
+    problems = [(logit(rs.rand(D)), (np.log(0.5 + k), init_nn_params(0.1, [D, 5, 1], npr.RandomState(k))))
+                for k in range(K)]
+    batch_noise_u, batch_noise_v = rs.rand(K, 100, D), rs.rand(K, 100, D)
+    batch_params, batch_est_params = stack_problems(problems)
+    def problem_slice(structure, k):
+        if isinstance(structure, (tuple, list)):
+            return type(structure)(problem_slice(item, k) for item in structure)
+        return structure[k]
+    with profile() as profiler:
+        batched_results = batched_relax_all(batch_params, batch_est_params, batch_noise_u, batch_noise_v,
+                                            lambda b: np.sum((b - batch_targets)**2, axis=-1, keepdims=True))
+        differences = []
+        for k, (problem_params, problem_est_params) in enumerate(problems):
+            results = relax_all(problem_params, problem_est_params, batch_noise_u[k], batch_noise_v[k],
+                                lambda b: np.sum((b - batch_targets[k])**2, axis=-1, keepdims=True))
+            batched_k = [batched_results[0][k], batched_results[1][k], problem_slice(batched_results[2], k)]
+            differences += [np.max(np.abs(flatten(a)[0] - flatten(b)[0])) for a, b in zip(results, batched_k)]
+    print("Objective, grads, d_var   : {}".format(max(differences)))
+    batched_report, per_problem_report = profiler.reports[0], sum(profiler.reports[2:], profiler.reports[1])
+    print("Rows, batched / relax_all : {} / {}".format(sorted(batched_report.rows.items()),
+                                                   sorted(per_problem_report.rows.items())))
+
+    print("\n\nIn-place flat_adam vs autograd's adam on RELAX, 3000 steps, max abs difference:")
+    def relax_step(seed):
+        def combined_grad(combined_params, t):
+            step_rs = npr.RandomState(seed + t)
+            _, grads, d_var_d_est = relax_all(combined_params[0], combined_params[1], step_rs.rand(10, D),
+                                              step_rs.rand(10, D), objective, reduce=True)
+            return grads[0], d_var_d_est
+        return combined_grad
+    init_combined_params = (params, (0.0, nn_params))
+    print("Parameters                : {}".format(np.max(np.abs(
+        flatten(adam(relax_step(0), init_combined_params, step_size=0.01, num_iters=3000))[0] -
+        flatten(flat_adam(relax_step(0), FlatParams(init_combined_params), step_size=0.01, num_iters=3000))[0]))))
+
+    print("\n\nfloat32 vs float64 estimator means, max abs difference:")
+    float32_targets = np.linspace(0.2, 0.9, D).astype(np.float32)
+
+    def float32_objective(b):  # keeps the dtype of relaxed samples, so REBAR stays in float32
+        return np.sum((b - float32_targets)**2, axis=-1, keepdims=True)
+
+    noise_u[:2], noise_v[2:4] = [[0.0], [1.0]], [[0.0], [1.0]]  # must stay finite in float32
+    for name, method, est_params in [("Rebar", rebar_all, (0.0, np.log(0.3))),
+                                     ("Relax", relax_all, (0.0, nn_params))]:
+        _, grads64, _ = method(params, est_params, noise_u, noise_v, float32_objective)
+        with precision(np.float32):
+            _, grads32, _ = method(params, est_params, noise_u, noise_v, float32_objective)
+        print("{:<26}: {} ({})".format(name, np.max(np.abs(np.mean(grads32, axis=0) - np.mean(grads64, axis=0))),
+                                       grads32.dtype))
+    print("bernoulli_logprob(0.3, 1) : {} vs {} for float32 arrays".format(
+        bernoulli_logprob(0.3, 1), bernoulli_logprob(np.array([0.3], dtype=np.float32), np.array([1]))))
+
+    print("\n\nCost accounting, objective / surrogate calls and rows per estimator call (REBAR's surrogate wraps f):")
+    with profile() as profiler:
+        rebar_all(params, (0.0, np.log(0.3)), noise_u, noise_v, objective)
+        relax_all(params, (0.0, nn_params), noise_u, noise_v, objective)
+    for report in profiler.reports:
+        print("{:<26}: {} / {} calls, {} / {} rows".format(
+            report.name, report.calls['objective'], report.calls['surrogate'],
+            report.rows['objective'], report.rows['surrogate']))
+    print("Run total                 : {} calls, {} peak bytes".format(profiler.total().num_calls, profiler.total().peak_bytes))
+
+    print("\n\nPhilox noise blocks regenerated on demand match the full arrays:")
+    noise = PhiloxNoise(D, seed=0)
+    noise_u, noise_v = noise(7, num_samples)
+    print("Sample block              : {}".format(np.array_equal(noise.noise_u(7, (100, 200)), noise_u[100:200])))
+    print("Sample and dimension block: {}".format(np.array_equal(noise.noise_v(7, (5, 9), (1, 3)), noise_v[5:9, 1:3])))
+
+    print("\n\nStreaming Monte Carlo of RELAX in chunks of 1000 vs one batch, max abs difference:")
+    relax_estimator = lambda u, v: relax_all(params, (0.0, nn_params), u, v, objective)
+    _, grads, vargrads = relax_estimator(noise_u, noise_v)
+    _, grad_mean, grad_var, vargrads_stream = streaming_mc(relax_estimator, noise, num_samples, 1000, step=7)
+    print("Gradient mean             : {}".format(np.max(np.abs(grad_mean - np.mean(grads, axis=0)))))
+    print("Gradient variance         : {}".format(np.max(np.abs(grad_var - np.var(grads, axis=0)))))
+    print("Gradient of variance      : {}".format(np.max(np.abs(flatten(vargrads_stream)[0] - flatten(vargrads)[0]))))
+
+    print("\n\nREBAR gradient under each noise generator, 8192 samples:")
+    print("Exact              : {}".format(exact_objective_and_grad(objective, params)[1]))
+    rebar_estimator = lambda u, v: rebar(params, (np.log(1.0), np.log(0.3)), u, v, objective)
+    for name, noise in [("I.i.d. (Philox)", PhiloxNoise(D)), ("Antithetic", AntitheticNoise(D)),
+                        ("Sobol", QMCNoise(D)), ("Halton", QMCNoise(D, engine=qmc.Halton))]:
+        print("{:<19}: {}".format(name, streaming_mc(rebar_estimator, noise, 2**13)[1]))
+
+    print("\n\nClosed-form REBAR eta from running moments vs grid search over eta:")
+    eta_stats = OptimalEta(per_dimension=False)
+    for t in range(30):
+        rebar_optimal_eta_all(params, 0.0, *PhiloxNoise(D)(t, 100), f=objective, eta_stats=eta_stats)
+    noise_u, noise_v = PhiloxNoise(D)(1000, num_samples)
+    etas = np.linspace(0.5, 3.0, 26)
+    variances = [np.sum(np.var(rebar_all(params, (0.0, np.log(eta)), noise_u, noise_v, objective)[1], axis=0))
+                 for eta in etas]
+    print("Running estimate          : {}".format(eta_stats.eta))
+    print("Grid search               : {}".format(etas[np.argmin(variances)]))
+    objective_runs = [0]
+    def counted_objective(b):
+        objective_runs[0] += 1
+        return objective(b)
+    with profile() as profiler:
+        rebar_optimal_eta_all(params, 0.0, *PhiloxNoise(D)(0, 100), f=counted_objective, eta_stats=OptimalEta())
+    assert profiler.reports[0].calls['objective'] == objective_runs[0]
+    print("Objective calls / f runs  : {} / {}".format(profiler.reports[0].calls['objective'], objective_runs[0]))
+
+    print("\n\nRELAX with a leave-one-out baseline, 10 samples per step, 500 steps:")
+    print("Exact              : {}".format(exact_objective_and_grad(objective, params)[1]))
+    for name, leave_one_out in [("Relax", False), ("Relax, LOO", True)]:
+        step_means = np.array([relax_all(params, (0.0, nn_params), *PhiloxNoise(D)(t, 10), f=objective,
+                                         leave_one_out=leave_one_out)[1].mean(axis=0) for t in range(500)])
+        print("{:<19}: {} variance {}".format(name, np.mean(step_means, axis=0), np.sum(np.var(step_means, axis=0))))
+
+    print("\n\nCategorical gradient estimators, D = 2, K = 3:")
+    cat_D, K = 2, 3
+    logits = rs.randn(cat_D, K)
+    cat_targets = rs.rand(cat_D, K)
+
+    def cat_objective(b):
+        return np.sum((b - cat_targets)**2, axis=(-2, -1))[:, None]
+
+    def cat_expected_objective(logits):
+        configs = np.eye(K)[np.array(list(itertools.product(range(K), repeat=cat_D)))]
+        probs = np.exp(np.sum(configs * log_softmax(logits), axis=(-2, -1)))
+        return np.dot(probs, cat_objective(configs)[:, 0])
+
+    noise_u = rs.rand(num_samples, cat_D, K)
+    noise_v = rs.rand(num_samples, cat_D, K)
+    cat_nn_params = init_nn_params(0.1, [cat_D * K, 5, 1])
+    print("Exact              :\n{}".format(grad(cat_expected_objective)(logits)))
+    print("Rebar              :\n{}".format(categorical_rebar_all(
+        logits, (0.0, np.log(0.3)), noise_u, noise_v, cat_objective, reduce=True)[1][0]))
+    print("Relax              :\n{}".format(categorical_relax_all(
+        logits, (0.0, cat_nn_params), noise_u, noise_v, cat_objective, reduce=True)[1][0]))